@@ -0,0 +1,80 @@
+"""Fixtures for benchmarks of :mod:`requests_gracedb`."""
+from binascii import hexlify
+import multiprocessing
+import os
+
+import pytest
+from six.moves import socketserver
+
+from .utils import format_size
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    """Read HTTP requests, discard their bodies, and respond with 200 OK."""
+
+    def _discard(self, n):
+        while n:
+            data = self.rfile.read(min(n, 1 << 20))
+            if not data:
+                raise EOFError
+            n -= len(data)
+
+    def handle(self):
+        while self.rfile.readline():  # request line
+            headers = {}
+            for line in iter(self.rfile.readline, b'\r\n'):
+                if not line:
+                    return
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            if headers.get('transfer-encoding') == 'chunked':
+                size = None
+                while size != 0:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    self._discard(size + 2)
+            else:
+                self._discard(int(headers.get('content-length', 0)))
+            self.wfile.write(
+                b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nOK')
+
+
+def _serve(conn):
+    socketserver.ThreadingTCPServer.daemon_threads = True
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SinkHandler)
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+
+@pytest.fixture(scope='session')
+def sink_url():
+    """Run an HTTP server that discards request bodies in a separate process,
+    so that it does not count toward the CPU time or memory usage of the
+    benchmarks.
+    """
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, args=(child_conn,))
+    process.daemon = True
+    process.start()
+    yield 'http://127.0.0.1:{}/'.format(parent_conn.recv())
+    process.terminate()
+    process.join()
+
+
+@pytest.fixture(scope='session')
+def make_file(tmp_path_factory):
+    """Return a function to generate a file of a given size.
+
+    The files contain hexadecimal digits, which compress about 2:1.
+    """
+    tmpdir = tmp_path_factory.mktemp('files')
+    block = hexlify(os.urandom(1 << 19))
+
+    def make_file(size):
+        path = tmpdir / 'file{}.dat'.format(format_size(size))
+        if not path.exists():
+            with path.open('wb') as f:
+                for i in range(0, size, len(block)):
+                    f.write(block[:size - i])
+        return str(path)
+
+    return make_file
@@ -0,0 +1,90 @@
+"""Benchmarks for :mod:`requests_gracedb.cert_reload`.
+
+Run them with::
+
+    pytest benchmarks
+
+These benchmarks measure the cost of finding out when the client certificate
+expires and of setting up the SSL context, which happen every time that a new
+connection is opened.
+"""
+from datetime import datetime
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric.rsa import generate_private_key
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, NoEncryption, PrivateFormat)
+from cryptography.x509 import (
+    CertificateBuilder, Name, NameAttribute, random_serial_number)
+from cryptography.x509.oid import NameOID
+import pytest
+
+from requests_gracedb import cert_reload
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.fixture(scope='module')
+def key():
+    """Generate a client RSA key."""
+    return generate_private_key(65537, 2048, default_backend())
+
+
+@pytest.fixture(scope='module')
+def key_file(key, tmp_path_factory):
+    """Generate a client key file."""
+    path = tmp_path_factory.mktemp('key') / 'key.pem'
+    path.write_bytes(key.private_bytes(
+        Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()))
+    return str(path)
+
+
+@pytest.fixture(scope='module')
+def cert_file(key, tmp_path_factory):
+    """Generate a client certificate file."""
+    backend = default_backend()
+    name = Name([NameAttribute(NameOID.COMMON_NAME, u'example.org')])
+    cert = CertificateBuilder().subject_name(
+        name
+    ).issuer_name(
+        name
+    ).serial_number(
+        random_serial_number()
+    ).public_key(
+        key.public_key()
+    ).not_valid_before(
+        datetime(2008, 1, 1)
+    ).not_valid_after(
+        datetime(3019, 1, 10)
+    ).sign(
+        key, SHA256(), backend
+    )
+    path = tmp_path_factory.mktemp('cert') / 'cert.pem'
+    path.write_bytes(cert.public_bytes(Encoding.PEM))
+    return str(path)
+
+
+def test_not_valid_after_uncached(benchmark, cert_file):
+    """Benchmark reading and parsing the certificate for every connection."""
+    benchmark(lambda: cert_reload.load_x509_certificate(
+        cert_file).not_valid_after)
+
+
+def test_not_valid_after_cached(benchmark, cert_file):
+    """Benchmark looking up the certificate in the cache."""
+    cert_reload._get_not_valid_after(cert_file)
+    benchmark(cert_reload._get_not_valid_after, cert_file)
+
+
+def test_ssl_context_uncached(benchmark, cert_file, key_file):
+    """Benchmark loading the certificate and key for every connection."""
+    benchmark(cert_reload._build_ssl_context,
+              cert_file, key_file, None, None, None, None)
+
+
+def test_ssl_context_cached(benchmark, cert_file, key_file):
+    """Benchmark looking up the SSL context in the cache."""
+    args = (cert_file, key_file, None, None, None, None)
+    cert_reload._get_ssl_context(*args)
+    benchmark(cert_reload._get_ssl_context, *args)
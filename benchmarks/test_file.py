@@ -0,0 +1,52 @@
+"""Benchmarks for :mod:`requests_gracedb.file`.
+
+Run them with::
+
+    pytest benchmarks
+
+The upload throughput, CPU time, and increase in peak resident set size for
+each upload mode and file size are recorded in the ``extra_info`` of each
+benchmark. Use ``--benchmark-json`` to save them, or ``--benchmark-autosave``
+and ``--benchmark-compare`` to check for regressions. The files are uploaded to
+a local HTTP server that discards the request bodies.
+"""
+from time import process_time
+
+import pytest
+
+from requests_gracedb import Session
+
+from .utils import (
+    current_rss, FILE_SIZES, format_size, peak_rss, reset_peak_rss)
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.mark.parametrize('size', FILE_SIZES, ids=format_size)
+@pytest.mark.parametrize('upload_mode,upload_compression', [
+    ['buffered', None], ['stream', None], ['mmap', None], ['stream', 'gzip']])
+def test_upload(benchmark, sink_url, make_file, size, upload_mode,
+                upload_compression):
+    """Benchmark uploading a file by path."""
+    filename = make_file(size)
+    client = Session(sink_url, force_noauth=True, upload_mode=upload_mode,
+                     upload_compression=upload_compression)
+    client.get(sink_url)  # Open the connection ahead of time.
+
+    def upload():
+        client.post(sink_url, files={'file': (filename, None)})
+
+    rounds = 5 if size < 1 << 28 else 1
+    reset_peak_rss()
+    rss = current_rss()
+    cpu_time = process_time()
+    benchmark.pedantic(upload, rounds=rounds, iterations=1)
+    cpu_time = (process_time() - cpu_time) / rounds
+
+    # There are no statistics if benchmarking is disabled or skipped.
+    if benchmark.stats is not None:
+        benchmark.extra_info.update(
+            size=size,
+            throughput_MBps=size / benchmark.stats.stats.mean / 1e6,
+            cpu_time_s=cpu_time,
+            peak_rss_increase_bytes=peak_rss() - rss)
@@ -0,0 +1,64 @@
+"""Benchmarks for :mod:`requests_gracedb.http2`.
+
+Run them with::
+
+    pytest benchmarks
+
+Each benchmark sends a batch of concurrent requests to a local HTTP/2 server
+that requires a client certificate. The number of TLS connections that the
+server accepted is recorded in the ``extra_info`` of each benchmark.
+"""
+from multiprocessing.pool import ThreadPool
+import ssl
+
+import pytest
+
+from requests_gracedb import Session
+
+pytest.importorskip('pytest_benchmark')
+pytest.importorskip('h2')
+pytest.importorskip('httpx')
+
+from requests_gracedb.tests.test_http2 import H2Server, make_cert  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def certs(tmp_path_factory):
+    """Generate server and client certificates."""
+    tmpdir = tmp_path_factory.mktemp('certs')
+    return make_cert(tmpdir, 'server'), make_cert(tmpdir, 'client')
+
+
+@pytest.fixture(scope='module')
+def server(certs):
+    """Run a local HTTP/2 server."""
+    server_cert, client_cert = certs
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*server_cert)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(client_cert[0])
+    server = H2Server(context)
+    yield server
+    server.close()
+
+
+@pytest.mark.parametrize('concurrency', [1, 8, 32])
+def test_http2_requests(benchmark, server, certs, concurrency):
+    """Benchmark sending 64 requests from a number of threads."""
+    server_cert, client_cert = certs
+    url = server.url_for('/')
+    pool = ThreadPool(concurrency)
+    with Session(url, cert=client_cert, http2=True) as client:
+        client.verify = server_cert[0]
+        client.get(url)  # Open the connection ahead of time.
+        connections = server.connections
+
+        def send():
+            pool.map(lambda _: client.get(url).content, range(64))
+
+        benchmark(send)
+    pool.close()
+
+    benchmark.extra_info.update(
+        concurrency=concurrency,
+        connections=server.connections - connections + 1)
@@ -0,0 +1,66 @@
+"""Helpers for benchmarks of :mod:`requests_gracedb`."""
+import os
+import resource
+
+
+def parse_size(size):
+    """Parse a size in bytes with an optional K, M, or G suffix."""
+    size = size.strip().upper()
+    for i, suffix in enumerate('KMG'):
+        if size.endswith(suffix):
+            return int(size[:-1]) << (10 * (i + 1))
+    return int(size)
+
+
+def format_size(size):
+    """Format a size in bytes with a K, M, or G suffix."""
+    for suffix in 'GMK':
+        shift = 10 * ('KMG'.index(suffix) + 1)
+        if size >= 1 << shift and size % (1 << shift) == 0:
+            return '{}{}'.format(size >> shift, suffix)
+    return str(size)
+
+
+#: File sizes to benchmark. Set the environment variable
+#: :envvar:`BENCHMARK_FILE_SIZES` to a comma-separated list such as
+#: ``1K,1M,1G,4G`` to benchmark larger files.
+FILE_SIZES = [parse_size(size) for size in os.environ.get(
+    'BENCHMARK_FILE_SIZES', '1K,1M,64M').split(',')]
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process to its current
+    resident set size, if the operating system supports it (Linux).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+
+def _read_proc_status(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                value, unit = line.split()[1:]
+                assert unit == 'kB'
+                return int(value) << 10
+
+
+def current_rss():
+    """Get the current resident set size of this process in bytes."""
+    try:
+        return _read_proc_status('VmRSS')
+    except IOError:
+        return 0
+
+
+def peak_rss():
+    """Get the peak resident set size of this process in bytes."""
+    try:
+        return _read_proc_status('VmHWM')
+    except IOError:
+        # On macOS, ru_maxrss is in bytes; elsewhere, it is in kilobytes.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname()[0] == 'Darwin' else maxrss << 10
@@ -21,6 +21,7 @@ import requests.sessions
 from .auth import SessionAuthMixin
 from .errors import SessionErrorMixin
 from .file import SessionFileMixin
+from .prewarm import SessionPrewarmMixin
 from .user_agent import SessionUserAgentMixin
 
 from ._version import get_versions
@@ -30,7 +31,8 @@ del get_versions
 __all__ = ('Session',)
 
 
-class Session(SessionAuthMixin,
+class Session(SessionPrewarmMixin,
+              SessionAuthMixin,
               SessionErrorMixin,
               SessionFileMixin,
               SessionUserAgentMixin,
@@ -41,6 +43,9 @@ class Session(SessionAuthMixin,
 
     It adds the following behaviors to the session:
 
+    * Open connections to the service in the background ahead of the first
+      request (see :class:`~requests_gracedb.prewarm.SessionPrewarmMixin`)
+
     * GraceDB-style authentication
       (see :class:`~requests_gracedb.auth.SessionAuthMixin`)
 
@@ -14,13 +14,23 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
-from os import access, environ, getuid, R_OK
+from os import access, environ, getuid, R_OK, stat
 from os.path import expanduser, join
+from threading import Lock
+
+import six
 from six.moves.urllib.parse import urlparse
 
+from requests.adapters import HTTPAdapter
+from requests.cookies import extract_cookies_to_jar
+from requests.sessions import preferred_clock
+from requests.utils import rewind_body
 from safe_netrc import netrc
+from urllib3.util.url import parse_url
 
+from .bearer_token import BearerTokenAuth
 from .cert_reload import CertReloadingHTTPAdapter
+from .http2 import CertReloadingHTTP2Adapter
 
 
 def _find_cert():
@@ -55,13 +65,27 @@ def _find_cert():
         return result
 
 
+def _find_token_file():
+    """Try to find a user's bearer token file.
+
+    Checks the environment variable :envvar:`BEARER_TOKEN_FILE` first, then
+    the default locations from the WLCG Bearer Token Discovery specification.
+    """
+    result = environ.get('BEARER_TOKEN_FILE')
+    if result:
+        return result
+
+    for directory in (environ.get('XDG_RUNTIME_DIR'), '/tmp'):
+        if directory:
+            result = join(directory, 'bt_u{}'.format(getuid()))
+            if access(result, R_OK):
+                return result
+
+
 def _find_username_password(url):
     host = urlparse(url).hostname
 
-    try:
-        result = netrc().authenticators(host)
-    except IOError:
-        result = None
+    result = _netrc_index.authenticators(host)
 
     if result is not None:
         username, _, password = result
@@ -70,6 +94,162 @@ def _find_username_password(url):
     return result
 
 
+def _path_state(path):
+    """Return a key that changes whenever a file is created, removed,
+    replaced, modified, or has its permissions changed."""
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    # FIXME: Python 2 does not have st_mtime_ns
+    mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+    return (st.st_dev, st.st_ino, mtime, st.st_size, st.st_mode, st.st_uid)
+
+
+_discovery_cache = {}
+_discovery_cache_lock = Lock()
+
+
+def _memoize(key, env, paths, func, *args):
+    """Call a credential discovery function, or return its previous result
+    if none of the environment variables and files that it depends on have
+    changed since then.
+
+    Parameters
+    ----------
+    key : tuple
+        The cache key.
+    env : tuple
+        The names of the environment variables that the function reads.
+    paths : tuple
+        The names of the files that the function reads.
+    func : callable
+        The discovery function.
+    *args
+        Arguments for the function.
+
+    """
+    state = (tuple(environ.get(name) for name in env),
+             tuple(_path_state(path) for path in paths))
+    with _discovery_cache_lock:
+        cached = _discovery_cache.get(key)
+    if cached is not None and cached[0] == state:
+        return cached[1]
+    result = func(*args)
+    with _discovery_cache_lock:
+        _discovery_cache[key] = (state, result)
+    return result
+
+
+def _discover_cert():
+    """Memoized version of :func:`_find_cert`."""
+    paths = (join('/tmp', 'x509up_u{}'.format(getuid())),) + tuple(
+        expanduser(join('~', '.globus', filename))
+        for filename in ('usercert.pem', 'userkey.pem'))
+    return _memoize(('cert', getuid()),
+                    ('X509_USER_CERT', 'X509_USER_KEY', 'X509_USER_PROXY',
+                     'HOME'),
+                    paths, _find_cert)
+
+
+def _discover_token_file():
+    """Memoized version of :func:`_find_token_file`."""
+    filename = 'bt_u{}'.format(getuid())
+    paths = (join('/tmp', filename),)
+    directory = environ.get('XDG_RUNTIME_DIR')
+    if directory:
+        paths += (join(directory, filename),)
+    return _memoize(('token', getuid()),
+                    ('BEARER_TOKEN_FILE', 'XDG_RUNTIME_DIR'),
+                    paths, _find_token_file)
+
+
+def _cert_state(cert):
+    """Return a key that changes whenever any of the files of a client
+    certificate changes."""
+    if cert is None:
+        return None
+    if isinstance(cert, six.string_types):
+        cert = (cert,)
+    return tuple(_path_state(path) for path in cert)
+
+
+def _clear_pools(adapter, url):
+    """Close the connection pools of a transport adapter for the host of a
+    URL, so that new connections are made with the current client
+    certificate. Pools for other hosts are kept."""
+    poolmanager = getattr(adapter, 'poolmanager', None)
+    if poolmanager is None:
+        return
+    parsed = parse_url(url)
+    scheme = (parsed.scheme or 'http').lower()
+    host = (parsed.host or '').lower()
+    port = parsed.port or {'http': 80, 'https': 443}.get(scheme)
+    for key in poolmanager.pools.keys():
+        if (key.key_scheme, key.key_host, key.key_port) \
+                == (scheme, host, port):
+            try:
+                del poolmanager.pools[key]
+            except KeyError:
+                pass
+
+
+def _is_rewindable(request):
+    """Determine whether a request can be sent again."""
+    body = request.body
+    return body is None or isinstance(body, (bytes, six.text_type)) \
+        or isinstance(getattr(request, '_body_position', None),
+                      six.integer_types)
+
+
+# Minimum time in seconds between searches for new credentials after
+# authentication failures.
+_REDISCOVERY_INTERVAL = 10
+
+
+class _NetrcIndex(object):
+    """The entries of the netrc file, indexed by host name.
+
+    The file is parsed once for the whole process. It is only parsed again if
+    the :envvar:`NETRC` environment variable changes or if :func:`os.stat`
+    shows that the file has been created, modified, or removed since then.
+    Lookups are thread-safe.
+    """
+
+    def __init__(self):
+        # (path, state of the file, hosts)
+        self._index = (None, None, {})
+        self._lock = Lock()
+
+    def authenticators(self, host):
+        """Return a tuple of ``(login, account, password)`` for the host, or
+        for the default entry, or None if there is no matching entry.
+
+        Like :meth:`netrc.netrc.authenticators`, but without parsing the file
+        again.
+        """
+        path = environ.get('NETRC') or expanduser(join('~', '.netrc'))
+        state = _path_state(path)
+        index = self._index
+        if index[:2] != (path, state):
+            with self._lock:
+                index = self._index
+                if index[:2] != (path, state):
+                    index = self._index = (path, state, self._parse(path))
+        hosts = index[2]
+        return hosts.get(host, hosts.get('default'))
+
+    @staticmethod
+    def _parse(path):
+        try:
+            return netrc(path).hosts
+        except IOError:
+            return {}
+
+
+_netrc_index = _NetrcIndex()
+
+
 class SessionAuthMixin(object):
     """A mixin for :class:`requests.Session` to add support for all GraceDB
     authentication mechanisms.
@@ -86,6 +266,11 @@ class SessionAuthMixin(object):
         Username for basic auth.
     password : str
         Password for basic auth.
+    token : str, callable
+        Bearer token for token auth (such as a SciToken). May be either the
+        name of a file that contains the token, or a function that takes no
+        arguments and returns the token (see
+        :class:`~requests_gracedb.bearer_token.BearerTokenAuth`).
     force_noauth : bool, default=False
         If true, then do not use any authentication at all.
     fail_if_noauth : bool, default=False
@@ -96,6 +281,39 @@ class SessionAuthMixin(object):
         expires.
     cert_reload_timeout : int, default=300
         Reload the certificate this many seconds before it expires.
+    cert_reload_watch : bool, default=False
+        If true, then watch the client certificate files in a background
+        thread and reload the certificate as soon as it changes on disk (see
+        :class:`~requests_gracedb.cert_reload.CertReloadingHTTPAdapter`).
+        Only has an effect if `cert_reload` is true.
+    cert_reload_rollover : bool, default=False
+        If true, then when the client certificate changes or is about to
+        expire, establish new connections in the background and swap them in
+        all at once, so that requests do not stall (see
+        :class:`~requests_gracedb.cert_reload.CertReloadingHTTPAdapter`).
+        Implies `cert_reload_watch`. Only has an effect if `cert_reload` is
+        true.
+    http2 : bool, default=False
+        If true, then multiplex concurrent requests to each host over a single
+        HTTP/2 connection (see
+        :class:`~requests_gracedb.http2.CertReloadingHTTP2Adapter`). Requires
+        the optional :mod:`httpx` package with HTTP/2 support. Client
+        certificates are reloaded when they change, and also before they
+        expire if `cert_reload` is true. Cannot be combined with
+        `cert_reload_watch`, `cert_reload_rollover`, or the pool options.
+    pool_connections : int, optional
+        The number of hosts for which to keep connection pools (see
+        :class:`requests.adapters.HTTPAdapter`).
+    pool_maxsize : int, optional
+        The maximum number of idle connections to keep for each host. If
+        more threads than this share the session, then connections are
+        discarded and reopened (see :class:`requests.adapters.HTTPAdapter`).
+    pool_adaptive : bool, default=False
+        If true, then grow and shrink the connection pool of each host
+        according to the number of connections that are in use at the same
+        time (see
+        :class:`~requests_gracedb.cert_reload.CertReloadingHTTPAdapter`).
+        Requires `cert_reload`.
 
     Notes
     -----
@@ -111,7 +329,17 @@ class SessionAuthMixin(object):
     3.  If the :obj:`username` and :obj:`password` keyword arguments are
         provided, then use basic auth.
 
-    4.  Look for a default X.509 client certificate in:
+    4.  If the :obj:`token` keyword argument is provided, then use bearer
+        token auth.
+
+    5.  Look for a default bearer token file in:
+
+        a.  the environment variable :envvar:`BEARER_TOKEN_FILE`
+        b.  the file :file:`$XDG_RUNTIME_DIR/bt_u{UID}`, where :samp:`{UID}`
+            is your numeric user ID, if the file exists and is readable
+        c.  the file :file:`/tmp/bt_u{UID}`, if it exists and is readable
+
+    6.  Look for a default X.509 client certificate in:
 
         a.  the environment variables :envvar:`X509_USER_CERT` and
             :envvar:`X509_USER_KEY`
@@ -121,13 +349,41 @@ class SessionAuthMixin(object):
         d.  the files :file:`~/.globus/usercert.pem` and
             :file:`~/.globus/userkey.pem`, if they exist and are readable
 
-    5.  Read the netrc file [1]_ located at :file:`~/.netrc`, or at the path
+    7.  Read the netrc file [1]_ located at :file:`~/.netrc`, or at the path
         stored in the environment variable :envvar:`NETRC`, and look for a
-        username and password matching the hostname in the URL.
+        username and password matching the host name.
 
-    6.  If the :obj:`fail_if_noauth` keyword argument is true, and no
+    8.  If the :obj:`fail_if_noauth` keyword argument is true, and no
         authentication source was found, then raise a :class:`ValueError`.
 
+    Bearer tokens are cached and refreshed in the background shortly before
+    they expire.
+
+    Steps 5 through 7 are deferred until the :attr:`cert` or :attr:`auth`
+    attribute is first used, which is usually when the first request is
+    made, unless the :obj:`fail_if_noauth` keyword argument is true. Their
+    results are cached for the whole process, and are looked up again only
+    if the relevant environment variables change or if any of the files are
+    created, modified, or removed.
+
+    The :attr:`cert` and :attr:`auth` attributes hold the credentials for the
+    host in the URL. If the credentials came from steps 5 through 7, then
+    requests to other hosts use the credentials that these steps find for
+    those hosts instead, such as a different netrc entry. They are looked up
+    when the first request to each host is made, and cached by the session.
+    Explicitly provided credentials are used for all hosts.
+
+    If the server responds to a request with an HTTP 401 or 403 status code,
+    then the session looks for new credentials: it repeats steps 5 through 7
+    if the credentials came from them, fetches the bearer token again, and
+    checks whether the client certificate files have changed. If the
+    credentials have changed, then the request is sent once more with the new
+    credentials. This happens at most once every few seconds for all of the
+    threads that share the session. Connections are only reopened if the
+    client certificate has changed, and only for the host of the request.
+    Requests whose bodies cannot be rewound, such as streamed uploads, are
+    not sent again.
+
     References
     ----------
     .. [1] The .netrc file.
@@ -136,14 +392,39 @@ class SessionAuthMixin(object):
     """  # noqa: E501
 
     def __init__(self, url=None, cert=None, username=None, password=None,
-                 force_noauth=False, fail_if_noauth=False, cert_reload=False,
-                 cert_reload_timeout=300, **kwargs):
+                 token=None, force_noauth=False, fail_if_noauth=False,
+                 cert_reload=False, cert_reload_timeout=300,
+                 cert_reload_watch=False, cert_reload_rollover=False,
+                 http2=False,
+                 pool_connections=None, pool_maxsize=None, pool_adaptive=False,
+                 **kwargs):
+        self._auth_lock = Lock()
+        self._reauth_lock = Lock()
+        self._host_credentials = {}
         super(SessionAuthMixin, self).__init__(**kwargs)
 
         # Support for reloading client certificates
-        if cert_reload:
+        pool_kwargs = {key: value for key, value in (
+            ('pool_connections', pool_connections),
+            ('pool_maxsize', pool_maxsize)) if value is not None}
+        if http2:
+            if cert_reload_watch or cert_reload_rollover or pool_kwargs \
+                    or pool_adaptive:
+                raise ValueError(
+                    'cert_reload_watch, cert_reload_rollover, and the pool '
+                    'options are not supported with http2.')
+            self.mount('https://', CertReloadingHTTP2Adapter(
+                cert_reload_timeout=cert_reload_timeout if cert_reload else 0))
+        elif cert_reload:
             self.mount('https://', CertReloadingHTTPAdapter(
-                cert_reload_timeout=cert_reload_timeout))
+                cert_reload_timeout=cert_reload_timeout,
+                cert_watch=cert_reload_watch,
+                cert_rollover=cert_reload_rollover,
+                pool_adaptive=pool_adaptive, **pool_kwargs))
+        elif pool_adaptive:
+            raise ValueError('pool_adaptive requires cert_reload.')
+        elif pool_kwargs:
+            self.mount('https://', HTTPAdapter(**pool_kwargs))
 
         # Argument validation
         if fail_if_noauth and force_noauth:
@@ -152,22 +433,197 @@ class SessionAuthMixin(object):
         if (username is None) ^ (password is None):
             raise ValueError('Must provide username and password, or neither.')
 
-        # FIXME: these should go into elif clauses below
-        # (as in `elif default_cert := _find_x509_credentials():`)
-        # in order to defer unnecessary I/O,  but this requires
-        # the := operator, which requires Python 3.8.
-        default_cert = _find_cert()
-        default_basic_auth = _find_username_password(url)
-
         if force_noauth:
             pass
         elif cert is not None:
             self.cert = cert
         elif username is not None:
             self.auth = (username, password)
-        elif default_cert is not None:
-            self.cert = default_cert
-        elif default_basic_auth is not None:
-            self.auth = default_basic_auth
-        elif fail_if_noauth:
-            raise ValueError('No authentication credentials found.')
+        elif token is not None:
+            self.auth = BearerTokenAuth(token)
+        else:
+            # Look for default credentials when they are first needed.
+            self._default_auth_url = self._discovery_url = url
+            if fail_if_noauth:
+                self._resolve_default_auth()
+                if self.cert is None and self.auth is None:
+                    raise ValueError('No authentication credentials found.')
+
+        if not force_noauth:
+            # Must run before the response hook of SessionErrorMixin.
+            self.hooks['response'].insert(0, self._hook_reauth)
+
+    # Credentials that were given explicitly or that have been discovered.
+    _cert = None
+    _auth = None
+
+    # The state of the client certificate files when they were last checked.
+    _cert_state = None
+
+    # The URL for which default credentials have yet to be discovered.
+    _default_auth_url = False
+
+    # The URL for which default credentials were discovered.
+    _discovery_url = False
+
+    # The times of the last search for new credentials, and of the last
+    # change of the client certificate files that it found.
+    _last_rediscovery = None
+    _cert_changed_at = None
+
+    @staticmethod
+    def _discover_default_auth(url):
+        """Return the default ``(cert, auth)``."""
+        default_token = _discover_token_file()
+        if default_token is not None:
+            return None, BearerTokenAuth(default_token)
+        default_cert = _discover_cert()
+        if default_cert is not None:
+            return default_cert, None
+        return None, _find_username_password(url)
+
+    def _resolve_default_auth(self):
+        if self._default_auth_url is False:
+            return
+        with self._auth_lock:
+            url = self._default_auth_url
+            if url is False:
+                return
+            self._cert, self._auth = self._discover_default_auth(url)
+            self._cert_state = _cert_state(self._cert)
+            self._host_credentials = {
+                urlparse(url).hostname: (self._cert, self._auth)}
+            self._default_auth_url = False
+
+    def _get_credentials(self, url):
+        """Return the ``(cert, auth)`` to use for a request to a URL."""
+        self._resolve_default_auth()
+        if self._discovery_url is False:
+            return self._cert, self._auth
+        host = urlparse(url).hostname
+        try:
+            return self._host_credentials[host]
+        except KeyError:
+            pass
+        with self._auth_lock:
+            credentials = self._host_credentials.get(host)
+            if credentials is None:
+                credentials = self._discover_default_auth(url)
+                # Build a new dictionary so that lookups need no lock.
+                host_credentials = dict(self._host_credentials)
+                host_credentials[host] = credentials
+                self._host_credentials = host_credentials
+        return credentials
+
+    def _rediscover_auth(self):
+        """Look for new credentials after an authentication failure, unless
+        any thread has already done so recently."""
+        self._resolve_default_auth()
+        with self._reauth_lock:
+            now = preferred_clock()
+            if self._last_rediscovery is not None \
+                    and now - self._last_rediscovery < _REDISCOVERY_INTERVAL:
+                return
+            self._last_rediscovery = now
+            with self._auth_lock:
+                if self._discovery_url is not False:
+                    cert, auth = self._discover_default_auth(
+                        self._discovery_url)
+                    # Keep the same token cache if the token source is the
+                    # same.
+                    if auth != self._auth:
+                        self._auth = auth
+                    self._cert = cert
+                    self._host_credentials = {
+                        urlparse(self._discovery_url).hostname: (cert, auth)}
+                if isinstance(self._auth, BearerTokenAuth):
+                    self._auth.invalidate()
+                state = _cert_state(self._cert)
+                if state != self._cert_state:
+                    self._cert_state = state
+                    self._cert_changed_at = now
+
+    def prepare_request(self, request):
+        prep = super(SessionAuthMixin, self).prepare_request(request)
+        # Remember whether the session's credentials were used, so that they
+        # may be replaced after an authentication failure.
+        prep._session_auth = request.auth is None
+        if prep._session_auth and self._discovery_url is not False:
+            auth = self._get_credentials(prep.url)[1]
+            if auth != self.auth:
+                prep.headers.pop('Authorization', None)
+                if auth is not None:
+                    prep.prepare_auth(auth, prep.url)
+        return prep
+
+    def merge_environment_settings(self, url, proxies, stream, verify, cert):
+        if cert is None and self._discovery_url is not False:
+            cert = self._get_credentials(url)[0]
+        return super(SessionAuthMixin, self).merge_environment_settings(
+            url, proxies, stream, verify, cert)
+
+    def _hook_reauth(self, response, **kwargs):
+        """Response hook to send a request again with new credentials if it
+        failed to authenticate."""
+        request = response.request
+        if response.status_code not in (401, 403) \
+                or not _is_rewindable(request):
+            return response
+        sent_at = preferred_clock() - response.elapsed.total_seconds()
+
+        old_cert = self._get_credentials(request.url)[0]
+        self._rediscover_auth()
+        new_cert, auth = self._get_credentials(request.url)
+
+        prep = request.copy()
+        if auth is not None and getattr(request, '_session_auth', False):
+            prep.headers.pop('Authorization', None)
+            prep.prepare_auth(auth, prep.url)
+        cert = kwargs.get('cert')
+        cert_changed = False
+        if cert is not None and cert == old_cert:
+            cert_changed = new_cert != cert \
+                or self._cert_changed_at is not None \
+                and sent_at <= self._cert_changed_at
+            kwargs['cert'] = new_cert
+        if not cert_changed and prep.headers.get('Authorization') \
+                == request.headers.get('Authorization'):
+            return response
+
+        # Consume content and release the original connection.
+        response.content
+        response.close()
+        if getattr(prep, '_body_position', None) is not None:
+            rewind_body(prep)
+        extract_cookies_to_jar(prep._cookies, request, response.raw)
+        prep.prepare_cookies(prep._cookies)
+        if cert_changed:
+            _clear_pools(response.connection, prep.url)
+
+        new_response = response.connection.send(prep, **kwargs)
+        new_response.history.append(response)
+        new_response.request = prep
+        return new_response
+
+    @property
+    def cert(self):
+        self._resolve_default_auth()
+        return self._cert
+
+    @cert.setter
+    def cert(self, value):
+        self._resolve_default_auth()
+        self._cert = value
+        self._cert_state = _cert_state(value)
+        self._discovery_url = False
+
+    @property
+    def auth(self):
+        self._resolve_default_auth()
+        return self._auth
+
+    @auth.setter
+    def auth(self, value):
+        self._resolve_default_auth()
+        self._auth = value
+        self._discovery_url = False
@@ -0,0 +1,206 @@
+#
+# Copyright (C) 2019-2020  Leo P. Singer <leo.singer@ligo.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Bearer token (SciToken or OAuth) authentication."""
+from base64 import urlsafe_b64decode
+import json
+import logging
+from threading import Condition, Lock, Thread
+from time import time
+
+from requests.auth import AuthBase
+
+__all__ = ('BearerTokenAuth',)
+
+log = logging.getLogger(__name__)
+
+# Refresh tokens this many seconds before they expire, or halfway through
+# their lifetime if that is sooner.
+_TOKEN_REFRESH_MARGIN = 60
+
+# Assume that tokens without an expiration time are valid for this many
+# seconds.
+_TOKEN_DEFAULT_LIFETIME = 60
+
+# Minimum time in seconds between background attempts to refresh a token
+# that is not yet expired.
+_TOKEN_RETRY_INTERVAL = 5
+
+
+def _get_expiration(token):
+    """Get the expiration time of a JSON Web Token.
+
+    Parameters
+    ----------
+    token : str
+        The token.
+
+    Returns
+    -------
+    exp : float or None
+        The expiration time in seconds since the epoch, or None if the token
+        is not a JSON Web Token or if it has no expiration time.
+
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(urlsafe_b64decode(payload.encode('ascii')).decode(
+            'utf-8'))['exp']
+        return float(exp)
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _read_token_file(filename):
+    with open(filename) as f:
+        return f.read().strip()
+
+
+class _TokenCache(object):
+    """A bearer token that is refreshed ahead of its expiration time.
+
+    When the token is about to expire, the first thread that uses it starts
+    a refresh in the background and keeps using the current token in the
+    meantime. When the token has already expired, or has not been fetched
+    yet, one thread fetches it and the others wait for the result, so that
+    the token source is not hit by every thread at once.
+    """
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        # (token, time to start refreshing, expiration time)
+        self._state = (None, 0.0, 0.0)
+        self._last_attempt = 0.0
+        self._refreshing = False
+        self._cond = Condition(Lock())
+
+    def get(self):
+        token, refresh, expires = self._state
+        now = time()
+        if token is not None and now < expires:
+            if now >= refresh:
+                self._refresh_in_background(now)
+            return token
+        return self._refresh_and_wait()
+
+    def _refresh(self):
+        try:
+            token = self._fetch()
+            now = time()
+            expires = _get_expiration(token)
+            if expires is None:
+                expires = now + _TOKEN_DEFAULT_LIFETIME
+            refresh = expires - min(
+                _TOKEN_REFRESH_MARGIN, 0.5 * (expires - now))
+            self._state = (token, refresh, expires)
+        finally:
+            with self._cond:
+                self._refreshing = False
+                self._cond.notify_all()
+
+    def _refresh_logged(self):
+        try:
+            self._refresh()
+        except Exception:
+            log.exception('Failed to refresh bearer token')
+
+    def _refresh_in_background(self, now):
+        with self._cond:
+            if self._refreshing \
+                    or now - self._last_attempt < _TOKEN_RETRY_INTERVAL:
+                return
+            self._refreshing = True
+            self._last_attempt = now
+        thread = Thread(target=self._refresh_logged, name='BearerTokenRefresh')
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_and_wait(self):
+        with self._cond:
+            if self._refreshing:
+                while self._refreshing:
+                    self._cond.wait()
+                token = self._state[0]
+                if token is not None:
+                    return token
+            self._refreshing = True
+        self._refresh()
+        return self._state[0]
+
+    def invalidate(self):
+        """Forget the token, so that it is fetched again when it is next
+        used."""
+        self._state = (None, 0.0, 0.0)
+
+
+_file_caches = {}
+_file_caches_lock = Lock()
+
+
+def _get_file_cache(filename):
+    """Get the token cache for a token file, which is shared by all sessions
+    in the process."""
+    with _file_caches_lock:
+        try:
+            return _file_caches[filename]
+        except KeyError:
+            cache = _file_caches[filename] = _TokenCache(
+                lambda: _read_token_file(filename))
+            return cache
+
+
+class BearerTokenAuth(AuthBase):
+    """Attach a bearer token to requests.
+
+    Parameters
+    ----------
+    token : str or callable
+        Either the name of a file that contains the token, or a function
+        that takes no arguments and returns the token as a string.
+
+    Notes
+    -----
+    The token is cached and refreshed in the background shortly before it
+    expires, according to its ``exp`` claim if it is a JSON Web Token (such
+    as a SciToken). Other tokens are fetched again every minute. The cache
+    for a token file is shared by all sessions in the process.
+
+    """
+
+    def __init__(self, token):
+        self.token = token
+        if callable(token):
+            self._cache = _TokenCache(token)
+        else:
+            self._cache = _get_file_cache(token)
+
+    def __eq__(self, other):
+        return isinstance(other, BearerTokenAuth) and self.token == other.token
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.token)
+
+    def invalidate(self):
+        """Fetch the token again when it is next used."""
+        self._cache.invalidate()
+
+    def __call__(self, r):
+        r.headers['Authorization'] = 'Bearer ' + self._cache.get()
+        return r
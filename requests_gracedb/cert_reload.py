@@ -16,17 +16,39 @@
 #
 """HTTPS adapter to close connections with expired client certificates."""
 from __future__ import absolute_import
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+import ctypes
+import ctypes.util
 from datetime import datetime, timedelta
 from functools import partial
+import errno
+from heapq import heappop, heappush
+from itertools import count
+import logging
+import os
+from select import select
+import ssl
+from threading import Condition, Event, Lock, Thread, local
+from timeit import default_timer
+from weakref import WeakSet, ref
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.x509 import load_pem_x509_certificate
 from requests.packages.urllib3.connection import HTTPSConnection
 from requests.packages.urllib3.connectionpool import (HTTPConnectionPool,
                                                       HTTPSConnectionPool)
+from requests.packages.urllib3.exceptions import SSLError
+from requests.packages.urllib3.util.ssl_ import (
+    create_urllib3_context, resolve_cert_reqs, resolve_ssl_version)
+from requests import adapters
 from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_CA_BUNDLE_PATH, extract_zipped_paths
+from six.moves.queue import Full
 
 _backend = default_backend()
+log = logging.getLogger(__name__)
 
 
 def load_x509_certificate(filename):
@@ -48,46 +70,889 @@ def load_x509_certificate(filename):
     return load_pem_x509_certificate(data, _backend)
 
 
+_CERT_CACHE_SIZE = 64
+_cert_cache = OrderedDict()
+_cert_cache_lock = Lock()
+
+
+def _file_identity(filename):
+    """Return a key that changes whenever the file is replaced or modified."""
+    st = os.stat(filename)
+    # FIXME: Python 2 does not have st_mtime_ns
+    mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+    return (filename, st.st_dev, st.st_ino, mtime, st.st_size)
+
+
+def _get_not_valid_after(filename):
+    """Get the expiration time of the X.509 certificate in a file.
+
+    The result is cached for the whole process and keyed by the file's path,
+    inode, modification time, and size, so that the file is only read and
+    parsed again if it has changed.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the certificate file.
+
+    Returns
+    -------
+    not_valid_after : datetime.datetime
+        The expiration time of the certificate.
+
+    """
+    key = _file_identity(filename)
+    with _cert_cache_lock:
+        try:
+            # Move the entry to the end to mark it as most recently used.
+            # FIXME: Python 2 does not have OrderedDict.move_to_end
+            not_valid_after = _cert_cache[key] = _cert_cache.pop(key)
+        except KeyError:
+            pass
+        else:
+            return not_valid_after
+
+    not_valid_after = load_x509_certificate(filename).not_valid_after
+
+    with _cert_cache_lock:
+        for stale_key in [k for k in _cert_cache if k[0] == filename]:
+            del _cert_cache[stale_key]
+        _cert_cache[key] = not_valid_after
+        while len(_cert_cache) > _CERT_CACHE_SIZE:
+            _cert_cache.popitem(last=False)
+    return not_valid_after
+
+
+_SSL_CONTEXT_CACHE_SIZE = 16
+_ssl_context_cache = OrderedDict()
+_ssl_context_cache_lock = Lock()
+
+
+# FIXME: Python 2 does not support TLS session resumption
+_HAS_TLS_SESSIONS = all((hasattr(ssl.SSLSocket, 'session'),
+                         hasattr(ssl, 'PROTOCOL_TLS_CLIENT')))
+
+
+class _SessionResumingSSLContext(ssl.SSLContext):
+    """An SSL context that can offer a previous TLS session to the server.
+
+    urllib3 does not pass a session to :meth:`wrap_socket`, so a connection
+    that is about to connect calls :meth:`offer_session` to pass the session
+    to :meth:`wrap_socket` on the same thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._offered = local()
+
+    @contextmanager
+    def offer_session(self, session):
+        self._offered.session = session
+        try:
+            yield
+        finally:
+            self._offered.session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if kwargs.get('session') is None:
+            kwargs['session'] = getattr(self._offered, 'session', None)
+        return super(_SessionResumingSSLContext, self).wrap_socket(
+            sock, *args, **kwargs)
+
+
+class _TLSSessionCache(object):
+    """The most recent TLS session of the connections in a pool.
+
+    A session can only be resumed with the SSL context that created it, so
+    the session is forgotten when the context changes, which happens when the
+    client certificate changes.
+    """
+
+    def __init__(self):
+        self._context = None
+        self._session = None
+        self._lock = Lock()
+
+    def get(self, context):
+        with self._lock:
+            if self._context is context:
+                return self._session
+
+    def save(self, context, sock):
+        session = getattr(sock, 'session', None)
+        if session is None:
+            return
+        # In TLS 1.3, the session cannot be resumed until the server has sent
+        # a session ticket, which happens after the handshake.
+        if not session.has_ticket and sock.version() == 'TLSv1.3':
+            return
+        with self._lock:
+            self._context = context
+            self._session = session
+
+
+def _build_ssl_context(cert_file, key_file, ca_certs, ca_cert_dir, cert_reqs,
+                       ssl_version):
+    """Create an SSL context and load the certificates into it, in the same
+    way as :func:`urllib3.util.ssl_.ssl_wrap_socket`."""
+    if _HAS_TLS_SESSIONS and ssl_version is None:
+        context = _SessionResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        # urllib3 checks the host name itself.
+        context.check_hostname = False
+        context.verify_mode = resolve_cert_reqs(cert_reqs)
+        if getattr(context, 'post_handshake_auth', None) is not None:
+            context.post_handshake_auth = True
+    else:
+        context = create_urllib3_context(
+            ssl_version=resolve_ssl_version(ssl_version),
+            cert_reqs=resolve_cert_reqs(cert_reqs))
+    if ca_certs or ca_cert_dir:
+        try:
+            context.load_verify_locations(ca_certs, ca_cert_dir)
+        except (IOError, OSError) as e:
+            raise SSLError(e)
+    elif hasattr(context, 'load_default_certs'):
+        context.load_default_certs()
+    if cert_file:
+        context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+def _get_ssl_context(cert_file, key_file, ca_certs, ca_cert_dir, cert_reqs,
+                     ssl_version):
+    """Get an SSL context with the given client certificate and CA bundle.
+
+    The context is cached for the whole process, so that the certificate,
+    private key, and CA bundle are only read and parsed again if any of the
+    files has changed, rather than for every new connection.
+
+    Parameters
+    ----------
+    cert_file, key_file : str or None
+        The names of the client certificate and private key files.
+    ca_certs, ca_cert_dir : str or None
+        The name of the CA bundle file or directory.
+    cert_reqs, ssl_version : str, int, or None
+        The certificate verification mode and SSL version, as accepted by
+        :func:`urllib3.util.ssl_.create_urllib3_context`.
+
+    Returns
+    -------
+    context : ssl.SSLContext
+        The SSL context.
+
+    """
+    key = (cert_file, key_file, ca_certs, ca_cert_dir, cert_reqs, ssl_version)
+    identity = tuple(None if filename is None else _file_identity(filename)
+                     for filename in key[:4])
+    with _ssl_context_cache_lock:
+        try:
+            # FIXME: Python 2 does not have OrderedDict.move_to_end
+            cached_identity, context = _ssl_context_cache[key] = \
+                _ssl_context_cache.pop(key)
+        except KeyError:
+            pass
+        else:
+            if cached_identity == identity:
+                return context
+
+    context = _build_ssl_context(*key)
+
+    with _ssl_context_cache_lock:
+        _ssl_context_cache[key] = (identity, context)
+        while len(_ssl_context_cache) > _SSL_CONTEXT_CACHE_SIZE:
+            _ssl_context_cache.popitem(last=False)
+    return context
+
+
+# inotify(7) constants
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)  # FIXME: Python 2
+
+
+class _Inotify(object):
+    """Minimal wrapper for Linux inotify(7).
+
+    Raises OSError if inotify is not available.
+    """
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+
+    def add_watch(self, path):
+        # Watch the directory rather than the file itself in order to catch
+        # files that are replaced by renaming another file over them.
+        path = os.path.dirname(os.path.abspath(path)).encode()
+        if self._add_watch(
+                self.fd, path,
+                _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def wait(self, timeout):
+        """Wait until an event occurs or the timeout elapses."""
+        if select([self.fd], [], [], timeout)[0]:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _CertWatcher(object):
+    """Watch client certificate files in a background thread.
+
+    The watcher maintains a generation number that is incremented whenever a
+    watched file changes or whenever a watched certificate is going to expire
+    within `cert_reload_timeout` seconds. Connections record the generation
+    number when they are created, so checking whether a connection is stale
+    is just a comparison of integers. When the generation number changes, the
+    watcher immediately closes all idle connections in the pools that it
+    serves.
+
+    If `rollover` is true, then the watcher first opens replacement
+    connections in the background, and then swaps them in for the idle
+    connections with stale certificates all at once, so that requests do not
+    have to wait for new connections to be established.
+
+    On Linux, the watcher is woken up by inotify as soon as a file changes.
+    Otherwise, it polls the files' modification times every `interval`
+    seconds.
+
+    The watcher thread exits when :meth:`stop` is called or when all of the
+    pools that it serves have been garbage collected. It is started again if
+    a new pool connects.
+    """
+
+    def __init__(self, cert_reload_timeout=0, interval=1.0, rollover=False):
+        self.generation = 0
+        self.interval = interval
+        self.rollover = rollover
+        self._reload_timeout = timedelta(seconds=cert_reload_timeout)
+        self._files = {}  # path -> [identity, is_cert, has_expired]
+        self._pools = WeakSet()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+        self._inotify = None
+
+    def add_pool(self, pool):
+        with self._lock:
+            self._pools.add(pool)
+
+    def watch(self, cert_file, key_file=None):
+        with self._lock:
+            for path, is_cert in ((cert_file, True), (key_file, False)):
+                if path is None or path in self._files:
+                    continue
+                try:
+                    identity = _file_identity(path)
+                except OSError:
+                    identity = None
+                self._files[path] = [identity, is_cert, False]
+                if self._inotify is not None:
+                    self._add_watch(path)
+            if self._thread is None and not self._stopped.is_set():
+                self._start()
+
+    def _add_watch(self, path):
+        try:
+            self._inotify.add_watch(path)
+        except OSError:
+            pass
+
+    def _start(self):
+        """Start the watcher thread. Must be called with the lock held."""
+        try:
+            self._inotify = _Inotify()
+        except OSError:
+            self._inotify = None
+        else:
+            for path in self._files:
+                self._add_watch(path)
+        self._thread = Thread(target=self._run, name='CertWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the watcher thread. It exits the next time that it wakes up."""
+        with self._lock:
+            self._stopped.set()
+            if self._thread is None and self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+
+    def _check(self):
+        """Check the watched files, and return the number of seconds until
+        the next watched certificate is due to be reloaded.
+        """
+        changed = False
+        timeout = self.interval
+        with self._lock:
+            files = list(self._files.items())
+        for path, state in files:
+            identity, is_cert, has_expired = state
+            try:
+                new_identity = _file_identity(path)
+            except OSError:
+                new_identity = None
+            if new_identity != identity:
+                state[0] = new_identity
+                state[2] = has_expired = False
+                changed = True
+            if is_cert and new_identity is not None and not has_expired:
+                try:
+                    expires = _get_not_valid_after(path) - datetime.utcnow()
+                except (OSError, ValueError):
+                    continue
+                remaining = (expires - self._reload_timeout).total_seconds()
+                if remaining <= 0:
+                    state[2] = True
+                    changed = True
+                else:
+                    timeout = min(timeout, remaining)
+        if changed:
+            generation = self.generation + 1
+            with self._lock:
+                pools = list(self._pools)
+            if self.rollover:
+                # Open replacement connections before publishing the new
+                # generation number, so that requests keep using the old
+                # connections in the meantime.
+                replacements = [pool._prewarm_conns(generation)
+                                for pool in pools]
+            else:
+                replacements = [()] * len(pools)
+            self.generation = generation
+            for pool, conns in zip(pools, replacements):
+                pool._close_stale_conns(conns)
+        return timeout
+
+    def _run(self):
+        while True:
+            with self._lock:
+                # Exit if the watcher has been stopped, or if nobody is using
+                # it anymore because all of its pools have been garbage
+                # collected.
+                if self._stopped.is_set() or not self._pools:
+                    if self._inotify is not None:
+                        self._inotify.close()
+                        self._inotify = None
+                    self._thread = None
+                    return
+                inotify = self._inotify
+            try:
+                timeout = self._check()
+            except Exception:
+                # Keep watching: if the thread died, then stale connections
+                # would never be closed.
+                log.exception('Error while checking certificate files')
+                timeout = self.interval
+            if inotify is not None:
+                inotify.wait(timeout)
+            else:
+                self._stopped.wait(timeout)
+
+
+# Maximum time in seconds for the reaper to sleep before checking the clock.
+_REAPER_MAX_WAIT = 60
+
+
+class _ExpiryReaper(object):
+    """Close idle connections in a background thread when their certificates
+    are about to expire.
+
+    Pools schedule a deadline whenever they take back a connection with a new
+    expiration time. The deadlines are kept in a heap, so the reaper only has
+    to look at the earliest one to decide how long to sleep. When a deadline
+    passes, the reaper closes the idle connections in that pool whose
+    certificates have expired. Pools also hand over any expired connections
+    that they come across during checkout, so that requests never wait for
+    sockets to be closed.
+
+    There is a single reaper thread per process. It only holds weak
+    references to the pools, and it is started the first time that it is
+    needed.
+    """
+
+    def __init__(self):
+        self._heap = []  # (deadline, sequence number, weak ref to pool)
+        self._counter = count()
+        self._closing = []
+        self._cond = Condition(Lock())
+        self._thread = None
+
+    def schedule(self, pool, deadline):
+        with self._cond:
+            heappush(self._heap, (deadline, next(self._counter), ref(pool)))
+            self._wake()
+
+    def close_later(self, conn):
+        with self._cond:
+            self._closing.append(conn)
+            self._wake()
+
+    def _wake(self):
+        """Start or wake up the reaper thread. Must be called with the lock
+        held.
+        """
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='CertExpiryReaper')
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._cond.notify()
+
+    def _next(self):
+        """Wait for work, and return the connections to close and the pools
+        that have reached their deadlines.
+        """
+        with self._cond:
+            while True:
+                now = datetime.utcnow()
+                pools = []
+                while self._heap and self._heap[0][0] <= now:
+                    pools.append(heappop(self._heap)[2])
+                conns, self._closing = self._closing, []
+                if conns or pools:
+                    return conns, pools
+                timeout = _REAPER_MAX_WAIT
+                if self._heap:
+                    remaining = (self._heap[0][0] - now).total_seconds()
+                    timeout = min(timeout, remaining)
+                self._cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            conns, pools = self._next()
+            try:
+                for conn in conns:
+                    conn.close()
+                for pool in pools:
+                    pool = pool()
+                    if pool is not None:
+                        pool._close_stale_conns()
+            except Exception:
+                log.exception('Error while closing expired connections')
+
+
+_reaper = _ExpiryReaper()
+
+
 class _CertReloadingHTTPSConnection(HTTPSConnection):
 
-    def __init__(self, host, cert_reload_timeout=0, **kwargs):
+    def __init__(self, host, cert_reload_timeout=0, cert_watcher=None,
+                 tls_sessions=None, pool_stats=None, **kwargs):
         super(_CertReloadingHTTPSConnection, self).__init__(host, **kwargs)
+        # Since version 2.32, requests passes its own process-wide default SSL
+        # context if verify=True. urllib3 would load the client certificate
+        # into that context for every connection, so treat it as if no
+        # context was given, and use the same CA bundle as requests does.
+        preloaded = getattr(adapters, '_preloaded_ssl_context', None)
+        self._default_ca_bundle = \
+            preloaded is not None and self.ssl_context is preloaded
+        if self._default_ca_bundle:
+            self.ssl_context = None
+        # Only share SSL contexts if the caller did not provide one.
+        self._shared_ssl_context = self.ssl_context is None
+        self._tls_sessions = tls_sessions
+        self._pool_stats = pool_stats
         self._not_valid_after = datetime.max
         self._reload_timeout = timedelta(seconds=cert_reload_timeout)
+        self._watcher = cert_watcher
+        if cert_watcher is not None:
+            self._generation = cert_watcher.generation
 
     @property
     def cert_has_expired(self):
+        if self._watcher is not None:
+            return self._generation != self._watcher.generation
         expires = self._not_valid_after - datetime.utcnow()
         return expires <= self._reload_timeout
 
     def connect(self):
-        if self.cert_file:
-            cert = load_x509_certificate(self.cert_file)
-            self._not_valid_after = cert.not_valid_after
-        super(_CertReloadingHTTPSConnection, self).connect()
+        if self._pool_stats is None:
+            self._connect()
+            return
+        start = default_timer()
+        self._connect()
+        self._pool_stats.observe('handshake_time', default_timer() - start)
+        self._pool_stats.count('connections_opened')
+        if isinstance(self.ssl_context, _SessionResumingSSLContext) \
+                and self._tls_sessions is not None:
+            reused = self.sock.session_reused
+            self._pool_stats.count(
+                'tls_session_hits' if reused else 'tls_session_misses')
+
+    def _connect(self):
+        if self._watcher is not None:
+            self._generation = self._watcher.generation
+            if self.cert_file:
+                self._watcher.watch(self.cert_file, self.key_file)
+        elif self.cert_file:
+            self._not_valid_after = _get_not_valid_after(self.cert_file)
+        if not self._shared_ssl_context \
+                or getattr(self, 'ca_cert_data', None) \
+                or getattr(self, 'key_password', None):
+            super(_CertReloadingHTTPSConnection, self).connect()
+            return
+
+        filenames = (self.cert_file, self.key_file,
+                     self.ca_certs, self.ca_cert_dir)
+        ca_certs = self.ca_certs
+        if self._default_ca_bundle and not ca_certs and not self.ca_cert_dir:
+            ca_certs = extract_zipped_paths(DEFAULT_CA_BUNDLE_PATH)
+        self.ssl_context = _get_ssl_context(
+            self.cert_file, self.key_file, ca_certs, self.ca_cert_dir,
+            cert_reqs=self.cert_reqs, ssl_version=self.ssl_version)
+        # The certificates are already loaded into the SSL context. Hide the
+        # filenames from urllib3 so that it does not load them again.
+        self.cert_file = self.key_file = None
+        self.ca_certs = self.ca_cert_dir = None
+        context = self.ssl_context
+        resume = isinstance(context, _SessionResumingSSLContext) \
+            and self._tls_sessions is not None
+        try:
+            if resume:
+                with context.offer_session(self._tls_sessions.get(context)):
+                    super(_CertReloadingHTTPSConnection, self).connect()
+            else:
+                super(_CertReloadingHTTPSConnection, self).connect()
+        finally:
+            (self.cert_file, self.key_file,
+             self.ca_certs, self.ca_cert_dir) = filenames
+        if resume:
+            self._tls_sessions.save(context, self.sock)
+
+    def save_tls_session(self):
+        """Remember the TLS session so that new connections can resume it."""
+        context = self.ssl_context
+        if self.sock is not None and self._tls_sessions is not None \
+                and isinstance(context, _SessionResumingSSLContext):
+            self._tls_sessions.save(context, self.sock)
+
+    def close(self):
+        # The server may close the connection after the first response, so
+        # save the session before the socket is closed.
+        self.save_tls_session()
+        super(_CertReloadingHTTPSConnection, self).close()
+
+
+# Maximum time in seconds to wait for a pre-warmed connection to connect.
+_PREWARM_TIMEOUT = 10
+
+# Maximum number of connections per host in an adaptive pool.
+_ADAPTIVE_POOL_LIMIT = 100
+
+# Interval in seconds at which an adaptive pool shrinks to the peak number of
+# connections that were in use at the same time.
+_ADAPTIVE_POOL_INTERVAL = 60
 
 
 class _CertReloadingHTTPSConnectionPool(HTTPSConnectionPool):
 
     ConnectionCls = _CertReloadingHTTPSConnection
 
-    def __init__(self, host, port=None, cert_reload_timeout=0, **kwargs):
+    def __init__(self, host, port=None, cert_reload_timeout=0,
+                 cert_watcher=None, pool_stats=None, pool_adaptive=False,
+                 **kwargs):
         super(_CertReloadingHTTPSConnectionPool, self).__init__(
             host, port=port, **kwargs)
+        self.stats = PoolStats(parent=pool_stats)
+        self._adaptive = pool_adaptive
+        self._min_maxsize = self.pool.maxsize
+        self._in_use = self._peak_in_use = 0
+        self._next_resize = default_timer() + _ADAPTIVE_POOL_INTERVAL
+        self._size_lock = Lock()
         self.conn_kw['cert_reload_timeout'] = cert_reload_timeout
+        self.conn_kw['tls_sessions'] = _TLSSessionCache()
+        self.conn_kw['pool_stats'] = self.stats
+        self._reap_deadline = None
+        if cert_watcher is not None:
+            self.conn_kw['cert_watcher'] = cert_watcher
+            cert_watcher.add_pool(self)
 
-    def _get_conn(self, timeout=None):
-        while True:
-            conn = super(_CertReloadingHTTPSConnectionPool, self)._get_conn(
-                timeout)
-            # Note: this loop is guaranteed to terminate because, even if the
-            # pool is completely drained, when we create a new connection, its
-            # `_not_valid_after` property is set to `datetime.max`, and the
-            # condition below will evaulate to `True`.
-            if not conn.cert_has_expired:
-                return conn
+    def _prewarm_conns(self, generation):
+        """Open a replacement for each idle connection, and mark the
+        replacements with the given certificate generation number.
+        """
+        pool = self.pool
+        if pool is None:  # The pool has been closed.
+            return []
+        with pool.mutex:
+            n = sum(conn is not None for conn in pool.queue)
+        conns = []
+        for _ in range(n):
+            conn = self._new_conn()
+            # The watcher thread pre-warms the pools one after another, so do
+            # not let an unreachable host hold up the others indefinitely.
+            timeout = conn.timeout
+            if not isinstance(timeout, (int, float)) \
+                    or timeout > _PREWARM_TIMEOUT:
+                conn.timeout = _PREWARM_TIMEOUT
+            try:
+                conn.connect()
+            except Exception:
+                # Fall back to connecting on demand.
+                conn.close()
+                break
+            finally:
+                # urllib3 sets the socket's read timeout for each request.
+                conn.timeout = timeout
+            conn._generation = generation
+            conns.append(conn)
+        return conns
+
+    def _close_stale_conns(self, replacements=()):
+        """Close idle connections with stale certificates, and atomically swap
+        in replacement connections, if any.
+        """
+        replacements = list(replacements)
+        stale = []
+        pool = self.pool
+        if pool is not None:
+            with pool.mutex:
+                queue = pool.queue
+                conns = []
+                for conn in queue:
+                    if conn is not None:
+                        if conn.cert_has_expired:
+                            stale.append(conn)
+                        else:
+                            conns.append(conn)
+                n = max(len(queue) - len(conns), 0)
+                conns += replacements[:n]
+                replacements = replacements[n:]
+                # Put the empty slots at the bottom of the LIFO queue, so
+                # that open connections are used first.
+                n = len(queue) - len(conns)
+                # FIXME: Python 2 lists do not have a clear() method, and
+                # deques (used by urllib3 1.x) do not support slice deletion.
+                while queue:
+                    queue.pop()
+                queue.extend([None] * n + conns)
+        if stale:
+            self.stats.count('connections_expired', len(stale))
+        for conn in stale + replacements:
             conn.close()
 
+    def _put_conn(self, conn):
+        # In TLS 1.3, session tickets arrive after the handshake, so save the
+        # session again once a response has been read.
+        if conn is not None:
+            conn.save_tls_session()
+            # Without a watcher, ask the reaper to close the connection when
+            # its certificate is about to expire. All connections in a pool
+            # normally share a certificate, so only schedule each distinct
+            # deadline once.
+            if conn._watcher is None and conn._not_valid_after != datetime.max:
+                deadline = conn._not_valid_after - conn._reload_timeout
+                if deadline != self._reap_deadline:
+                    self._reap_deadline = deadline
+                    _reaper.schedule(self, deadline)
+        with self._size_lock:
+            self._in_use = max(self._in_use - 1, 0)
+            resize = self._adaptive and default_timer() >= self._next_resize
+        self._return_conn(conn)
+        if resize:
+            self._shrink()
+
+    def _return_conn(self, conn):
+        pool = self.pool
+        if conn is not None and pool is not None:
+            try:
+                pool.put(conn, block=False)
+                return
+            except Full:
+                if self._adaptive and self._grow():
+                    pool.put(conn, block=False)
+                    return
+                self.stats.count('connections_discarded')
+        # Let urllib3 warn about the full pool and close the connection.
+        super(_CertReloadingHTTPSConnectionPool, self)._put_conn(conn)
+
+    def _grow(self):
+        """Make room for one more connection in the pool, unless it has
+        reached its maximum size. Return true if the pool has grown.
+        """
+        pool = self.pool
+        with pool.mutex:
+            if pool.maxsize >= max(_ADAPTIVE_POOL_LIMIT, self._min_maxsize):
+                return False
+            pool.maxsize += 1
+            pool.not_full.notify()
+        return True
+
+    def _shrink(self):
+        """Shrink the pool to the peak number of connections that were in
+        use at the same time since the last time that it was resized, but not
+        below its initial size, and close the surplus idle connections.
+        """
+        with self._size_lock:
+            maxsize = max(self._peak_in_use, self._min_maxsize)
+            self._peak_in_use = self._in_use
+            self._next_resize = default_timer() + _ADAPTIVE_POOL_INTERVAL
+        pool = self.pool
+        if pool is None:
+            return
+        surplus = []
+        with pool.mutex:
+            # Remove empty slots and the least recently used connections from
+            # the bottom of the LIFO queue.
+            conns = pool.queue
+            while len(conns) > maxsize:
+                surplus.append(conns[0])
+                del conns[0]
+            pool.maxsize = max(maxsize, len(conns))
+        for conn in surplus:
+            if conn is not None:
+                conn.close()
+
+    def _get_conn(self, timeout=None):
+        pool = self.pool
+        if self.block and pool is not None and pool.empty() \
+                and self._adaptive and self._grow():
+            # Add an empty slot for a new connection rather than waiting.
+            pool.put(None, block=False)
+        if self.block and pool is not None and pool.empty():
+            # All connections are in use, so we have to wait for one.
+            self.stats.count('pool_waits')
+            start = default_timer()
+            try:
+                conn = super(
+                    _CertReloadingHTTPSConnectionPool, self)._get_conn(timeout)
+            finally:
+                self.stats.observe('pool_wait_time', default_timer() - start)
+        else:
+            conn = super(
+                _CertReloadingHTTPSConnectionPool, self)._get_conn(timeout)
+        with self._size_lock:
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+        if not conn.cert_has_expired:
+            if conn.sock is not None:
+                self.stats.count('connections_reused')
+            return conn
+        # The reaper has not gotten to this connection yet. Let it close the
+        # socket, rather than making the request wait, and use a new
+        # connection in the same slot.
+        self.stats.count('connections_expired')
+        _reaper.close_later(conn)
+        return self._new_conn()
+
+
+class PoolStats(object):
+    """Thread-safe counters and histograms of connection pool activity.
+
+    Parameters
+    ----------
+    parent : PoolStats, optional
+        Another instance to which all updates are also applied. The adapter
+        uses this to add up the statistics of all of its pools.
+
+    Notes
+    -----
+    The following counters are kept:
+
+    ``connections_opened``
+        Connections that were established, including reconnections of
+        connections that the server had closed.
+    ``connections_reused``
+        Requests that were sent over an idle connection from the pool.
+    ``connections_expired``
+        Idle connections that were closed because their client certificate
+        expired or changed.
+    ``connections_discarded``
+        Connections that were closed after a request because the pool was
+        full. If this happens often, then the pool is too small.
+    ``pool_waits``
+        Requests that had to wait for a free connection because all of the
+        connections in a blocking pool were in use.
+    ``tls_session_hits``, ``tls_session_misses``
+        TLS handshakes that did and did not resume a previous session.
+
+    The following histograms of durations in seconds are kept:
+
+    ``handshake_time``
+        Time to establish a connection, including the TLS handshake.
+    ``pool_wait_time``
+        Time spent waiting for a free connection.
+
+    """
+
+    COUNTERS = ('connections_opened', 'connections_reused',
+                'connections_expired', 'connections_discarded', 'pool_waits',
+                'tls_session_hits', 'tls_session_misses')
+
+    HISTOGRAMS = ('handshake_time', 'pool_wait_time')
+
+    #: Upper bounds of the histogram buckets, in seconds.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0, float('inf'))
+
+    def __init__(self, parent=None):
+        self._parent = parent
+        self._lock = Lock()
+        self._counters = dict.fromkeys(self.COUNTERS, 0)
+        self._histograms = {
+            key: [0.0, [0] * len(self.BUCKETS)] for key in self.HISTOGRAMS}
+
+    def count(self, key, n=1):
+        """Increment a counter."""
+        with self._lock:
+            self._counters[key] += n
+        if self._parent is not None:
+            self._parent.count(key, n)
+
+    def observe(self, key, seconds):
+        """Record a duration in a histogram."""
+        i = bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms[key]
+            histogram[0] += seconds
+            histogram[1][i] += 1
+        if self._parent is not None:
+            self._parent.observe(key, seconds)
+
+    def __getitem__(self, key):
+        return self._counters[key]
+
+    def snapshot(self):
+        """Return a consistent copy of the statistics.
+
+        Returns
+        -------
+        dict
+            A dictionary that maps the name of each counter to its value, and
+            the name of each histogram to a dictionary with the keys
+            ``count`` (the number of durations), ``sum`` (their total in
+            seconds), and ``buckets`` (a list of pairs of the upper bound of
+            each bucket in seconds and the number of durations that fell into
+            it).
+
+        """
+        with self._lock:
+            result = dict(self._counters)
+            for key, (total, counts) in self._histograms.items():
+                result[key] = {'count': sum(counts), 'sum': total,
+                               'buckets': list(zip(self.BUCKETS, counts))}
+        return result
+
 
 class CertReloadingHTTPAdapter(HTTPAdapter):
     """A mixin for :class:`requests.Session` to automatically reload the client
@@ -98,14 +963,102 @@ class CertReloadingHTTPAdapter(HTTPAdapter):
     ----------
     cert_reload_timeout : int
         Reload the certificate if it expires within this many seconds from now.
+    cert_watch : bool, default=False
+        If true, then watch the certificate and key files in a background
+        thread. As soon as either file changes, or the certificate is going to
+        expire within `cert_reload_timeout` seconds, idle connections are
+        closed and new connections use the new certificate. The certificate's
+        expiration time is then no longer checked when a connection is taken
+        from the pool. On Linux, changes are detected immediately using
+        inotify; elsewhere, the files are polled.
+    cert_watch_interval : float, default=1.0
+        Check the watched files at least this often, in seconds.
+    cert_rollover : bool, default=False
+        If true, then when the certificate changes or is about to expire,
+        open and handshake replacement connections in the background and swap
+        them in for the idle connections all at once, so that requests do not
+        stall while new connections are established. Implies `cert_watch`.
+    pool_adaptive : bool, default=False
+        If true, then grow the pool of each host beyond `pool_maxsize` (up to
+        100 connections) when more connections are in use at the same time,
+        instead of discarding connections or waiting for free ones, and
+        periodically shrink it back to the peak number of connections that
+        were in use at the same time, but not below `pool_maxsize`.
+    **kwargs
+        Additional keyword arguments, such as `pool_connections`,
+        `pool_maxsize`, and `pool_block`, are passed to
+        :class:`requests.adapters.HTTPAdapter`.
+
+    Notes
+    -----
+    New connections resume the TLS session of a previous connection to the
+    same host and port if possible, which saves the server a full handshake.
+    Sessions are tied to the client certificate and are discarded when it
+    changes. The attributes `tls_session_hits` and `tls_session_misses` count
+    the handshakes that did and did not resume a session, respectively.
+
+    The adapter keeps statistics of connection reuse, certificate expiration,
+    handshake durations, and waiting for free connections. Call
+    :meth:`pool_stats` to read them. If the ``connections_discarded`` counter
+    grows, then `pool_maxsize` is too small for the number of threads that
+    share the session.
 
     """
 
-    def __init__(self, cert_reload_timeout=0, **kwargs):
+    def __init__(self, cert_reload_timeout=0, cert_watch=False,
+                 cert_watch_interval=1.0, cert_rollover=False,
+                 pool_adaptive=False, **kwargs):
         super(CertReloadingHTTPAdapter, self).__init__(**kwargs)
+        if cert_watch or cert_rollover:
+            self._cert_watcher = _CertWatcher(
+                cert_reload_timeout, cert_watch_interval, cert_rollover)
+        else:
+            self._cert_watcher = None
+        self._pool_stats = PoolStats()
         https_pool_cls = partial(
             _CertReloadingHTTPSConnectionPool,
-            cert_reload_timeout=cert_reload_timeout)
+            cert_reload_timeout=cert_reload_timeout,
+            cert_watcher=self._cert_watcher,
+            pool_stats=self._pool_stats,
+            pool_adaptive=pool_adaptive)
         self.poolmanager.pool_classes_by_scheme = {
             'http': HTTPConnectionPool,
             'https': https_pool_cls}
+
+    @property
+    def tls_session_hits(self):
+        """Number of TLS handshakes that resumed a previous session."""
+        return self._pool_stats['tls_session_hits']
+
+    @property
+    def tls_session_misses(self):
+        """Number of full TLS handshakes."""
+        return self._pool_stats['tls_session_misses']
+
+    def pool_stats(self, url=None):
+        """Return a snapshot of the connection pool statistics.
+
+        Parameters
+        ----------
+        url : str, optional
+            If given, then return the statistics of the pool for this URL's
+            host and port only. Otherwise, return the totals for all pools.
+
+        Returns
+        -------
+        dict
+            See :meth:`PoolStats.snapshot`.
+
+        """
+        if url is None:
+            return self._pool_stats.snapshot()
+        pool = self.poolmanager.connection_from_url(url)
+        stats = getattr(pool, 'stats', None)
+        if stats is None:  # Not an HTTPS pool.
+            return PoolStats().snapshot()
+        return stats.snapshot()
+
+    def close(self):
+        super(CertReloadingHTTPAdapter, self).close()
+        if self._cert_watcher is not None:
+            self._cert_watcher.stop()
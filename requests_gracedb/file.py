@@ -15,36 +15,171 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 from __future__ import absolute_import
-from os.path import basename
+from collections import namedtuple
+from copy import copy
+try:
+    from functools import lru_cache
+except ImportError:  # FIXME: Python 2
+    from backports.functools_lru_cache import lru_cache
+import json
+import mmap
+import os
+from os.path import abspath, basename, exists, getmtime, getsize
 from mimetypes import guess_type
+import re
 from sys import stdin
+from time import sleep
+try:
+    from time import monotonic
+except ImportError:  # FIXME: Python 2
+    from time import time as monotonic
+import zlib
 
-from requests.utils import guess_filename, to_key_val_list
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+from requests.packages.urllib3.fields import RequestField
+from requests.packages.urllib3.filepost import choose_boundary
+from requests.structures import CaseInsensitiveDict
+from requests.utils import guess_filename, super_len, to_key_val_list
+import six
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def _guess_content_type(filename):
-    return guess_type(filename)[0] or 'application/octet-stream'
+_UPLOAD_MODES = ('buffered', 'stream', 'mmap')
+
+_COMPRESSIONS = {
+    # name: (file extension, content type)
+    'gzip': ('.gz', 'application/gzip'),
+    'zstd': ('.zst', 'application/zstd'),
+}
+
+# Content types that are not worth compressing again.
+_COMPRESSED_CONTENT_TYPES = frozenset(
+    content_type for _, content_type in _COMPRESSIONS.values()) | frozenset((
+        'application/x-bzip2', 'application/x-xz', 'application/zip',
+        'image/gif', 'image/jpeg', 'image/png'))
+
+
+_CONTENT_TYPES = {
+    # Astronomy and gravitational-wave data formats
+    '.fits': 'application/fits',
+    '.fit': 'application/fits',
+    '.fts': 'application/fits',
+    '.h5': 'application/x-hdf5',
+    '.hdf': 'application/x-hdf5',
+    '.hdf5': 'application/x-hdf5',
+    '.xml': 'application/xml',
+    '.votable': 'application/x-votable+xml',
+    # Compressed files (including, for example, *.fits.gz and *.xml.gz)
+    '.bz2': 'application/x-bzip2',
+    '.gz': 'application/gzip',
+    '.xz': 'application/x-xz',
+    '.zip': 'application/zip',
+    '.zst': 'application/zstd',
+    # Other common attachments
+    '.csv': 'text/csv',
+    '.gif': 'image/gif',
+    '.htm': 'text/html',
+    '.html': 'text/html',
+    '.ini': 'text/plain',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.json': 'application/json',
+    '.log': 'text/plain',
+    '.pdf': 'application/pdf',
+    '.png': 'image/png',
+    '.ps': 'application/postscript',
+    '.svg': 'image/svg+xml',
+    '.txt': 'text/plain',
+}
+
+_MAGIC_NUMBERS = (
+    (b'SIMPLE  =', 'application/fits'),
+    (b'\x89HDF\r\n\x1a\n', 'application/x-hdf5'),
+    (b'<?xml', 'application/xml'),
+    (b'BZh', 'application/x-bzip2'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'\xfd7zXZ\x00', 'application/x-xz'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x28\xb5\x2f\xfd', 'application/zstd'),
+    (b'GIF8', 'image/gif'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'%!PS', 'application/postscript'),
+)
+
+_MAGIC_LENGTH = max(len(magic) for magic, _ in _MAGIC_NUMBERS)
+
+
+@lru_cache(maxsize=256)
+def _guess_content_type_from_extension(extension):
+    """Look up the content type for a file extension, which may be compound
+    (e.g. ``.fits.gz``).
+
+    Only the innermost extension is significant unless the compound extension
+    itself is known. Extensions that are not in our own table are looked up
+    in the system MIME type database.
+    """
+    content_type = _CONTENT_TYPES.get(
+        extension, _CONTENT_TYPES.get('.' + extension.rsplit('.', 1)[-1]))
+    if content_type is None and extension:
+        content_type = guess_type('file' + extension)[0]
+    return content_type
+
+
+def _guess_content_type_from_content(head):
+    """Guess the content type from the first few bytes of a file."""
+    head = bytes(head[:_MAGIC_LENGTH])
+    for magic, content_type in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return content_type
+
+
+def _guess_content_type(filename, content=None):
+    """Guess the content type of a file from its extension or, failing that,
+    from its content if it is in memory.
+    """
+    extension = '.'.join(basename(filename).lower().split('.')[1:][-2:])
+    if extension:
+        extension = '.' + extension
+    content_type = _guess_content_type_from_extension(extension)
+    if content_type is None and isinstance(
+            content, (bytes, bytearray, memoryview, mmap.mmap)):
+        content_type = _guess_content_type_from_content(content)
+    return content_type or 'application/octet-stream'
 
 
 def _guess_mime_type(key, val):
     if not isinstance(val, (tuple, list)):
         filename = guess_filename(val) or key
-        filetype = _guess_content_type(filename)
+        filetype = _guess_content_type(filename, val)
         val = (filename, val, filetype)
     elif len(val) < 3 or val[2] is None:
         filename = val[0]
-        filetype = _guess_content_type(filename)
+        filetype = _guess_content_type(
+            filename, val[1] if len(val) > 1 else None)
         # val = (*val[:2], filetype, *val[3:])
         # FIXME: Python 2
         val = tuple(val[:2]) + (filetype,) + tuple(val[3:])
     return key, val
 
 
-def _read_files(key, val):
+def _read_files(key, val, upload_mode='buffered'):
     if isinstance(val, (tuple, list)) and (len(val) < 2 or val[1] is None):
         filename = val[0]
-        with (stdin.buffer if filename == '-' else open(filename, 'rb')) as f:
-            data = f.read()
+        if upload_mode == 'buffered':
+            with (stdin.buffer if filename == '-'
+                  else open(filename, 'rb')) as f:
+                data = f.read()
+        elif filename == '-':
+            data = _PipeSource(stdin.buffer)
+        elif upload_mode == 'mmap':
+            data = _MmapSource(filename)
+        else:
+            data = _PathSource(filename)
         filename = basename(filename)
         # val = (filename, data, *val[2:])
         # FIXME: Python 2
@@ -52,18 +187,459 @@ def _read_files(key, val):
     return key, val
 
 
-def _prepare_file(key, val):
-    key, val = _read_files(key, val)
+def _prepare_file(key, val, upload_mode='buffered'):
+    key, val = _read_files(key, val, upload_mode)
     key, val = _guess_mime_type(key, val)
     return key, val
 
 
-def _prepare_files(files):
+def _prepare_files(files, upload_mode='buffered', executor=None):
     if files is not None:
-        files = [_prepare_file(k, v) for k, v in to_key_val_list(files)]
+        files = to_key_val_list(files)
+        if executor is None or len(files) < 2:
+            files = [_prepare_file(k, v, upload_mode) for k, v in files]
+        else:
+            # Executor.map returns results in the order of its arguments, so
+            # the original field order is preserved.
+            keys, vals = zip(*files)
+            files = list(executor.map(
+                _prepare_file, keys, vals, [upload_mode] * len(files)))
     return files
 
 
+class _Source(object):
+    """Base class for the content of a multipart field.
+
+    Subclasses have a `length` attribute, which is None if the length is not
+    known in advance, and an `iter_chunks` method.
+    """
+
+
+class _BufferSource(_Source):
+    """Content of a multipart field that is already in memory.
+
+    The chunks are views into the original buffer, not copies.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+
+    def iter_chunks(self, chunk_size):
+        view = memoryview(self.data)
+        if chunk_size is None:
+            yield view
+        else:
+            for i in range(0, self.length, chunk_size):
+                yield view[i:i + chunk_size]
+
+
+class _FileSource(_Source):
+    """Content of a multipart field that is read from a file object."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.length = super_len(fileobj)
+
+    def iter_chunks(self, chunk_size):
+        read = self.fileobj.read
+        chunk = read(chunk_size)
+        while chunk:
+            if isinstance(chunk, six.text_type):
+                chunk = chunk.encode('utf-8')
+            yield chunk
+            chunk = read(chunk_size)
+
+
+class _PipeSource(_Source):
+    """Content of a multipart field that is read from a pipe, such as stdin.
+
+    Data is passed through as soon as it arrives rather than when a full chunk
+    is available. The length is not known in advance.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.length = None
+
+    def iter_chunks(self, chunk_size):
+        # read1() returns as soon as any data is available.
+        read = getattr(self.fileobj, 'read1', self.fileobj.read)
+        chunk = read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = read(chunk_size)
+
+
+class _PathSource(_Source):
+    """Content of a multipart field that is read from a file on disk.
+
+    The file is not opened until the request body is sent. Exactly as many
+    bytes are sent as the file had when the request was prepared, so that the
+    body matches its Content-Length header even if the file grows in the
+    meantime. If the file has shrunk, then an :class:`IOError` is raised.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.length = getsize(path)
+
+    def _truncated(self):
+        return IOError(
+            'File {} is shorter than when the request was prepared'.format(
+                self.path))
+
+    def iter_chunks(self, chunk_size):
+        remaining = self.length
+        with open(self.path, 'rb') as f:
+            while remaining:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise self._truncated()
+                remaining -= len(chunk)
+                yield chunk
+
+
+class _MmapSource(_PathSource):
+    """Content of a multipart field that is memory-mapped from a file on disk.
+
+    The chunks are views into the mapped pages, so they are written to the
+    socket without being copied into a private buffer.
+    """
+
+    def iter_chunks(self, chunk_size):
+        if not self.length:  # Empty files cannot be memory-mapped.
+            return
+        with open(self.path, 'rb') as f:
+            try:
+                mapped = mmap.mmap(
+                    f.fileno(), self.length, access=mmap.ACCESS_READ)
+            except ValueError:  # The file is shorter than self.length.
+                raise self._truncated()
+        try:
+            if hasattr(mapped, 'madvise'):  # FIXME: Python < 3.8
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            for i in range(0, len(view), chunk_size):
+                chunk = view[i:i + chunk_size]
+                yield chunk
+                # Release each view once it has been sent, so that the
+                # mapping can be closed.
+                chunk.release()
+            view.release()
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                # A view is still in use because the request was aborted;
+                # the mapping will be closed when it is garbage collected.
+                pass
+
+
+class _CompressedSource(_Source):
+    """Content of a multipart field that is compressed as it is sent.
+
+    The compressed length is not known in advance.
+    """
+
+    def __init__(self, source, compression):
+        self.source = source
+        self.compression = compression
+        self.length = None
+
+    def _compressor(self):
+        if self.compression == 'gzip':
+            return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            return zstandard.ZstdCompressor().compressobj()
+
+    def iter_chunks(self, chunk_size):
+        compressor = self._compressor()
+        for chunk in self.source.iter_chunks(chunk_size):
+            # FIXME: Python 2 zlib does not accept memoryviews.
+            if six.PY2 and isinstance(chunk, memoryview):
+                chunk = chunk.tobytes()
+            chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        yield compressor.flush()
+
+
+UploadProgress = namedtuple('UploadProgress', (
+    'field', 'filename', 'bytes_sent', 'total_bytes', 'elapsed', 'throughput'))
+UploadProgress.__doc__ = """Progress of the upload of one file.
+
+Attributes
+----------
+field : str
+    The name of the form field.
+filename : str
+    The name of the file.
+bytes_sent : int
+    The number of bytes of the file that have been sent so far. If the file
+    is being compressed, then this is the number of uncompressed bytes.
+total_bytes : int or None
+    The size of the file in bytes, or None if it is not known in advance
+    (for example, if the file is read from stdin).
+elapsed : float
+    The time in seconds since the first chunk of the file was sent.
+throughput : float or None
+    The instantaneous throughput in bytes per second, measured over the
+    chunks that were sent since the clock last advanced (normally just the
+    last chunk), or None if the clock has not advanced since the upload
+    started.
+"""
+
+
+class _ProgressSource(_Source):
+    """Wrap the content of a multipart field to report progress."""
+
+    def __init__(self, source, callback, field, filename):
+        self.source = source
+        self.callback = callback
+        self.field = field
+        self.filename = filename
+        self.length = source.length
+
+    def iter_chunks(self, chunk_size):
+        bytes_sent = pending = 0
+        throughput = None
+        start = last = monotonic()
+        for chunk in self.source.iter_chunks(chunk_size):
+            yield chunk
+            # By the time that the generator is resumed, the chunk has been
+            # sent.
+            now = monotonic()
+            bytes_sent += len(chunk)
+            pending += len(chunk)
+            # Several chunks may be sent within one tick of the clock.
+            if now > last:
+                throughput = pending / (now - last)
+                pending = 0
+                last = now
+            self.callback(UploadProgress(
+                self.field, self.filename, bytes_sent, self.length,
+                now - start, throughput))
+
+
+def _to_bytes(chunk):
+    # FIXME: Python 2 bytes(memoryview) returns the repr of the memoryview.
+    return chunk.tobytes() if isinstance(chunk, memoryview) else chunk
+
+
+def _validate_upload_mode(upload_mode):
+    if upload_mode not in _UPLOAD_MODES:
+        raise ValueError('upload_mode must be one of {}'.format(
+            ', '.join(_UPLOAD_MODES)))
+    # FIXME: Python 2 memoryviews do not support mmap objects.
+    if upload_mode == 'mmap' and six.PY2:
+        raise ValueError("upload_mode='mmap' requires Python 3")
+
+
+def _validate_compression(compression):
+    if compression and compression not in _COMPRESSIONS:
+        raise ValueError('upload_compression must be one of {}'.format(
+            ', '.join(sorted(_COMPRESSIONS))))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError(
+            'zstd compression requires the zstandard package')
+
+
+def _make_source(data):
+    if isinstance(data, _Source):
+        return data
+    elif isinstance(data, six.text_type):
+        return _BufferSource(data.encode('utf-8'))
+    elif hasattr(data, 'read'):
+        return _FileSource(data)
+    else:
+        return _BufferSource(data)
+
+
+def _iter_fields(data, files, compression=None, progress=None):
+    """Generate multipart fields in the same manner as
+    :meth:`requests.models.RequestEncodingMixin._encode_files`.
+    """
+    for field, val in to_key_val_list(data or {}):
+        if isinstance(val, six.string_types + (bytes,)) \
+                or not hasattr(val, '__iter__'):
+            val = [val]
+        for v in val:
+            if v is not None:
+                if not isinstance(v, bytes):
+                    v = str(v)
+                if isinstance(field, bytes):
+                    field = field.decode('utf-8')
+                if isinstance(v, six.text_type):
+                    v = v.encode('utf-8')
+                yield RequestField.from_tuples(field, v)
+
+    for k, (fn, fp, ft, fh) in files:
+        if fp is not None:
+            source = _make_source(fp)
+            if progress is not None:
+                source = _ProgressSource(source, progress, k, fn)
+            if compression and ft not in _COMPRESSED_CONTENT_TYPES:
+                source = _CompressedSource(source, compression)
+                extension, ft = _COMPRESSIONS[compression]
+                fn += extension
+            rf = RequestField(name=k, data=source, filename=fn, headers=fh)
+            rf.make_multipart(content_type=ft)
+            yield rf
+
+
+class _MultipartBody(object):
+    """A multipart/form-data request body that is generated on the fly.
+
+    The body is a sequence of buffers: the boundaries, field headers, and
+    small form fields are coalesced into :class:`bytes` segments, and the file
+    contents are sent as they are without being concatenated with the rest of
+    the body. File contents that are in memory are sent as :class:`memoryview`
+    objects of the original buffers. Other file contents are read in chunks
+    of at most `chunk_size` bytes as the body is sent. Chunks may be
+    :class:`memoryview` objects that are only valid until the next chunk is
+    requested.
+
+    The body may be iterated more than once (for example, to follow a
+    redirect) if all of the file contents are in memory or are read from
+    paths.
+
+    Parameters
+    ----------
+    data : dict, list
+        Form fields.
+    files : list
+        File fields, as returned by :func:`_prepare_files`.
+    chunk_size : int, None
+        Maximum size in bytes of each chunk of file content. If None, then
+        file contents that are in memory are sent in one piece.
+    compression : {'gzip', 'zstd'}, optional
+        Compress file contents with this algorithm.
+    progress : callable, optional
+        Call this function with an :class:`UploadProgress` instance after
+        each chunk of file content is sent.
+
+    """
+
+    def __init__(self, data, files, chunk_size, compression=None,
+                 progress=None):
+        if isinstance(data, six.string_types + (bytes,)):
+            raise ValueError('Data must not be a string.')
+        files = [(k, tuple(v) + (None,) * (4 - len(v))) for k, v in files]
+
+        boundary = choose_boundary()
+        self.content_type = 'multipart/form-data; boundary={}'.format(
+            boundary)
+        self.chunk_size = chunk_size
+
+        # Coalesce boundaries, headers, and small form fields into single
+        # segments so that they go out in as few writes as possible.
+        boundary = boundary.encode('latin-1')
+        self._segments = segments = []
+        pending = b''
+        for field in _iter_fields(data, files, compression, progress):
+            pending += b'--' + boundary + b'\r\n'
+            pending += field.render_headers().encode('utf-8')
+            if isinstance(field.data, bytes):
+                pending += field.data
+            else:
+                segments.append(pending)
+                segments.append(field.data)
+                pending = b''
+            pending += b'\r\n'
+        pending += b'--' + boundary + b'--\r\n'
+        segments.append(pending)
+
+        # Requests uses this attribute to set the Content-Length header. If
+        # the length is not known, then requests falls back to chunked
+        # transfer encoding.
+        lengths = [
+            len(segment) if isinstance(segment, bytes) else segment.length
+            for segment in segments]
+        self.len = None if None in lengths else sum(lengths)
+        self._reader = None
+        self._buffer = b''
+
+    def __iter__(self):
+        for segment in self._segments:
+            if isinstance(segment, bytes):
+                yield segment
+            elif self.len is None:
+                # urllib3 1.x requires that the chunks of a chunked request
+                # body are bytes.
+                for chunk in segment.iter_chunks(self.chunk_size):
+                    yield _to_bytes(chunk)
+            else:
+                for chunk in segment.iter_chunks(self.chunk_size):
+                    yield chunk
+
+    def _read(self, size=-1):
+        """Read up to `size` bytes of the body, or all of the rest of the body
+        if `size` is negative, like a file object."""
+        if self._reader is None:
+            self._reader = (_to_bytes(chunk) for chunk in self)
+        buffer = self._buffer
+        while size < 0 or len(buffer) < size:
+            chunk = next(self._reader, None)
+            if chunk is None:
+                break
+            buffer += chunk
+        if size < 0:
+            size = len(buffer)
+        data, self._buffer = buffer[:size], buffer[size:]
+        return data
+
+    # FIXME: Python 2 httplib cannot send an iterable request body, but it
+    # can send a file-like object. (On Python 3, http.client would prefer
+    # read() to iteration, which would copy every chunk.)
+    if six.PY2:
+        read = _read
+
+
+_RANGE_PATTERN = re.compile(r'^bytes=0-(\d+)$')
+
+
+def _load_upload_state(state_file, identity):
+    """Load the offset of an interrupted resumable upload, or return None if
+    the state file does not exist or belongs to a different upload.
+    """
+    if state_file is None or not exists(state_file):
+        return None
+    with open(state_file) as f:
+        state = json.load(f)
+    if state.get('identity') != identity:
+        return None
+    return state['offset']
+
+
+def _save_upload_state(state_file, identity, offset):
+    if state_file is not None:
+        tmp_file = state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'identity': identity, 'offset': offset}, f)
+        os.rename(tmp_file, state_file)
+
+
+def _remove_upload_state(state_file):
+    if state_file is not None and exists(state_file):
+        os.remove(state_file)
+
+
+def _acknowledged_offset(response):
+    """Get the number of bytes that the server has persisted from the Range
+    header of a 308 Resume Incomplete response.
+    """
+    match = _RANGE_PATTERN.match(response.headers.get('Range', ''))
+    return int(match.group(1)) + 1 if match else 0
+
+
+def _is_retryable(exception):
+    if isinstance(exception, HTTPError):
+        response = exception.response
+        return response is not None and response.status_code >= 500
+    return isinstance(exception, (ConnectionError, Timeout))
+
+
 class SessionFileMixin(object):
     """A mixin for :class:`requests.Session` to add features for file uploads.
 
@@ -74,19 +650,234 @@ class SessionFileMixin(object):
 
     This mixin adds the following features:
 
-    * The MIME type is automatically guessed from the filename.
+    * The MIME type is automatically guessed from the filename, or from the
+      first few bytes of the file content if the file extension is not
+      recognized. Common astronomy formats such as FITS, HDF5, and VOEvent
+      are recognized independently of the system MIME type database.
     * If the file content is None, then the filename is treated as a path, and
       the file is opened and read. If the filename is `-`, then the file
-      content is read from stdin.
+      content is read from stdin. In the streaming upload modes, stdin is
+      passed through as data arrives, using chunked transfer encoding.
+    * Optionally, several files are opened and read concurrently.
+    * Optionally, files are compressed as they are sent.
+    * Optionally, the progress of each file upload is reported to a callback
+      function.
+    * The multipart request body is sent as a sequence of buffers, so that
+      file contents are never copied into one large concatenated body.
+    * Optionally, the multipart request body is streamed, so that file
+      contents are read from disk in chunks (or memory-mapped) as the request
+      is sent rather than loaded into memory all at once.
+
+    It also adds the :meth:`upload_resumable` method for uploading large files
+    in chunks that can be individually retried.
+
+    Parameters
+    ----------
+    upload_mode : {'buffered', 'stream', 'mmap'}, default='buffered'
+        How to encode requests that upload files. In ``'buffered'`` mode,
+        files are read into memory before the request is sent. In
+        ``'stream'`` mode, the request body is generated as it is sent and
+        peak memory usage does not depend on the size of the files. The
+        ``'mmap'`` mode is like ``'stream'``, except that files that are given
+        by path are memory-mapped and written to the socket directly from the
+        page cache, which is shared between threads and processes; it requires
+        Python 3. May be overridden for an individual request by passing the
+        `upload_mode` keyword argument to :meth:`request`.
+    upload_chunk_size : int, default=65536
+        In ``'stream'`` and ``'mmap'`` modes, send file contents in chunks of
+        this many bytes.
+    upload_executor : concurrent.futures.Executor, optional
+        If provided, then prepare the files of requests that upload more than
+        one file in parallel using this executor, for example a
+        :class:`concurrent.futures.ThreadPoolExecutor`. This speeds up
+        requests that read many files from slow or networked filesystems.
+    upload_compression : {'gzip', 'zstd'}, optional
+        If provided, then compress the contents of uploaded files with this
+        algorithm as they are sent. The filename of each compressed file is
+        given the extension ``.gz`` or ``.zst``, and its MIME type is set to
+        ``application/gzip`` or ``application/zstd``. Files that are already
+        compressed are sent as they are. Compression implies a streamed
+        request body, which is sent with chunked transfer encoding because its
+        length is not known in advance. The ``'zstd'`` algorithm requires the
+        :mod:`zstandard` package. May be overridden for an individual request
+        by passing the `upload_compression` keyword argument to
+        :meth:`request`, or disabled by passing ``upload_compression=False``.
+    upload_progress : callable, optional
+        If provided, then call this function with an :class:`UploadProgress`
+        instance after each chunk of each uploaded file is sent. The function
+        is called on the thread that sends the request, so it should return
+        quickly. Progress reporting implies a streamed request body. May be
+        overridden for an individual request by passing the `upload_progress`
+        keyword argument to :meth:`request`.
     """
 
+    def __init__(self, upload_mode='buffered', upload_chunk_size=65536,
+                 upload_executor=None, upload_compression=None,
+                 upload_progress=None, **kwargs):
+        super(SessionFileMixin, self).__init__(**kwargs)
+        _validate_upload_mode(upload_mode)
+        _validate_compression(upload_compression)
+        self.upload_mode = upload_mode
+        self.upload_chunk_size = upload_chunk_size
+        self.upload_executor = upload_executor
+        self.upload_compression = upload_compression
+        self.upload_progress = upload_progress
+
+    def prepare_request(self, request):
+        # Encode buffered uploads as a sequence of buffers rather than letting
+        # requests concatenate them into a single bytes object, which would
+        # briefly need twice as much memory as the files themselves.
+        # FIXME: Python 2 httplib would have to read such a body into memory
+        # anyway, so leave the encoding to requests.
+        if request.files and not six.PY2:
+            request = copy(request)
+            files = [_guess_mime_type(k, v)
+                     for k, v in to_key_val_list(request.files)]
+            files = [(k, (v[0], v[1].read()) + tuple(v[2:]))
+                     if hasattr(v[1], 'read') else (k, v) for k, v in files]
+            request.data = _MultipartBody(request.data, files, None)
+            request.files = None
+            request.headers = CaseInsensitiveDict(request.headers)
+            request.headers.setdefault(
+                'Content-Type', request.data.content_type)
+        return super(SessionFileMixin, self).prepare_request(request)
+
     def request(
             self, method, url, params=None, data=None, headers=None,
             cookies=None, files=None, auth=None, timeout=None,
             allow_redirects=True, proxies=None, hooks=None, stream=None,
-            verify=None, cert=None, json=None):
+            verify=None, cert=None, json=None, upload_mode=None,
+            upload_compression=None, upload_progress=None):
+        if upload_mode is None:
+            upload_mode = self.upload_mode
+        else:
+            _validate_upload_mode(upload_mode)
+        if upload_compression is None:
+            upload_compression = self.upload_compression
+        else:
+            _validate_compression(upload_compression)
+        if upload_progress is None:
+            upload_progress = self.upload_progress
+        files = _prepare_files(files, upload_mode, self.upload_executor)
+        stream_body = upload_mode != 'buffered' or upload_compression or \
+            upload_progress
+        if files and stream_body:
+            data = _MultipartBody(data, files, self.upload_chunk_size,
+                                  upload_compression, upload_progress)
+            files = None
+            headers = CaseInsensitiveDict(headers or {})
+            headers.setdefault('Content-Type', data.content_type)
         return super(SessionFileMixin, self).request(
             method, url, params=params, data=data, headers=headers,
-            cookies=cookies, files=_prepare_files(files), auth=auth,
-            timeout=timeout, allow_redirects=True, proxies=proxies,
+            cookies=cookies, files=files, auth=auth,
+            timeout=timeout, allow_redirects=allow_redirects, proxies=proxies,
             hooks=hooks, stream=stream, verify=verify, cert=cert, json=json)
+
+    def upload_resumable(self, url, path, chunk_size=8388608, state_file=None,
+                         max_retries=3, backoff_factor=0.5, headers=None,
+                         **kwargs):
+        """Upload a file in chunks, resending only the chunks that fail.
+
+        Parameters
+        ----------
+        url : str
+            The upload URL.
+        path : str
+            The name of the file to upload.
+        chunk_size : int, default=8388608
+            Send the file in chunks of this many bytes.
+        state_file : str, optional
+            If provided, then record the upload's progress in this file, so
+            that an interrupted upload can be resumed by calling this method
+            again with the same arguments, even from a different process. The
+            file is removed when the upload is complete.
+        max_retries : int, default=3
+            Give up if this many consecutive attempts to send a chunk fail
+            with a connection error, a timeout, or an HTTP 5xx status.
+        backoff_factor : float, default=0.5
+            Before the :samp:`{n}`-th consecutive retry, wait
+            :samp:`{backoff_factor} * 2 ** ({n} - 1)` seconds.
+        headers : dict, optional
+            Additional HTTP headers to send with each chunk.
+        **kwargs
+            Additional keyword arguments for :meth:`requests.Session.put`.
+
+        Returns
+        -------
+        response : requests.Response
+            The response to the final chunk.
+
+        Notes
+        -----
+        The server must implement the following protocol, which is the same
+        as that of Google's resumable uploads. Each chunk is sent as a PUT
+        request to `url` with a :samp:`Content-Range: bytes
+        {first}-{last}/{size}` header. The server responds to each chunk with
+        the status code 308 (Resume Incomplete) and a :samp:`Range:
+        bytes=0-{last}` header that acknowledges the bytes that it has
+        persisted, until it has received the whole file and responds with a
+        success status (200 or 201). After a failure, the client asks the
+        server how many bytes it has persisted by sending an empty PUT request
+        with a :samp:`Content-Range: bytes */{size}` header, and resumes from
+        there. When an upload is resumed from a state file, the client resumes
+        from the last acknowledged byte, so the server must ignore any bytes
+        of a chunk that it already has. An empty file is uploaded with a single
+        empty PUT request with a :samp:`Content-Range: bytes */0` header, to
+        which the server must respond with a success status.
+        """
+        size = getsize(path)
+        identity = {'url': url, 'path': abspath(path), 'size': size,
+                    'mtime': getmtime(path)}
+        offset = acknowledged = _load_upload_state(state_file, identity) or 0
+        retries = 0
+
+        with open(path, 'rb') as f:
+            while True:
+                chunk_headers = CaseInsensitiveDict(headers or {})
+                if size == 0:
+                    # There are no bytes to send, so complete the upload.
+                    chunk_headers['Content-Range'] = 'bytes */0'
+                    data = b''
+                elif offset is None or offset >= size:
+                    # Ask the server how much of the file it has.
+                    chunk_headers['Content-Range'] = 'bytes */{}'.format(size)
+                    data = b''
+                else:
+                    f.seek(offset)
+                    data = f.read(chunk_size)
+                    chunk_headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                        offset, offset + len(data) - 1, size)
+
+                try:
+                    response = self.put(
+                        url, data=data, headers=chunk_headers,
+                        allow_redirects=False, **kwargs)
+                except Exception as e:
+                    if not _is_retryable(e) or retries >= max_retries:
+                        raise
+                    retries += 1
+                    sleep(backoff_factor * 2 ** (retries - 1))
+                    offset = None
+                    continue
+
+                if response.status_code != 308:
+                    _remove_upload_state(state_file)
+                    return response
+                if size == 0:
+                    raise ValueError(
+                        'The server did not complete the upload of an empty '
+                        'file.')
+
+                was_query = offset is None or offset >= size
+                offset = _acknowledged_offset(response)
+                if was_query and offset >= size:
+                    raise ValueError(
+                        'The server acknowledged the whole file, but did not '
+                        'complete the upload.')
+                # Only count consecutive failures: a chunk that fails every
+                # time must eventually exhaust the retries, even though the
+                # query that follows each failure succeeds.
+                if offset > acknowledged:
+                    acknowledged = offset
+                    retries = 0
+                _save_upload_state(state_file, identity, offset)
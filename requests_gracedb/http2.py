@@ -0,0 +1,337 @@
+#
+# Copyright (C) 2019-2020  Leo P. Singer <leo.singer@ligo.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""HTTP/2 transport adapter with client certificate reloading."""
+from __future__ import absolute_import
+from datetime import datetime, timedelta
+from email.message import Message
+from functools import partial
+import os
+import ssl
+from threading import Lock
+
+from requests.adapters import BaseAdapter
+from requests.cookies import extract_cookies_to_jar
+from requests.exceptions import (
+    ChunkedEncodingError, ConnectionError, ConnectTimeout, ProxyError,
+    ReadTimeout, SSLError)
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import (
+    DEFAULT_CA_BUNDLE_PATH, extract_zipped_paths, get_encoding_from_headers,
+    select_proxy)
+import six
+
+from .cert_reload import _file_identity, _get_not_valid_after
+
+try:
+    import h2  # noqa: F401
+    import httpx
+except ImportError:
+    httpx = None
+
+__all__ = ('CertReloadingHTTP2Adapter',)
+
+# Headers that are specific to an HTTP/1.1 connection and that must not be
+# sent over HTTP/2.
+_HOP_BY_HOP_HEADERS = frozenset((
+    'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding',
+    'upgrade'))
+
+_READ_CHUNK_SIZE = 65536
+
+
+def _split_cert(cert):
+    if cert is None or isinstance(cert, six.string_types):
+        return cert, None
+    else:
+        return cert
+
+
+def _files_identity(verify, cert):
+    """Return a key that changes whenever any of the certificate files
+    changes."""
+    filenames = _split_cert(cert)
+    if isinstance(verify, six.string_types):
+        filenames += (verify,)
+    return tuple(None if filename is None else _file_identity(filename)
+                 for filename in filenames)
+
+
+def _build_ssl_context(verify, cert):
+    """Create an SSL context for the given `verify` and `cert` arguments of
+    :meth:`requests.adapters.BaseAdapter.send`."""
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        if verify is True:
+            verify = extract_zipped_paths(DEFAULT_CA_BUNDLE_PATH)
+        if os.path.isdir(verify):
+            context = ssl.create_default_context(capath=verify)
+        else:
+            context = ssl.create_default_context(cafile=verify)
+    cert_file, key_file = _split_cert(cert)
+    if cert_file:
+        context.load_cert_chain(cert_file, key_file)
+    return context
+
+
+class _HTTP2Client(object):
+    """An HTTP/2 client with a fixed client certificate and CA bundle.
+
+    The adapter replaces the client when the certificate changes. The old
+    client is retired: it is closed as soon as the responses that are still
+    using it have been closed.
+    """
+
+    def __init__(self, verify, cert, proxy, identity):
+        self.identity = identity
+        cert_file, _ = _split_cert(cert)
+        if cert_file:
+            self.not_valid_after = _get_not_valid_after(cert_file)
+        else:
+            self.not_valid_after = datetime.max
+        self.client = httpx.Client(
+            http2=True, verify=_build_ssl_context(verify, cert), proxy=proxy,
+            timeout=None, trust_env=False)
+        self._active = 0
+        self._retired = False
+        self._lock = Lock()
+
+    def has_expired(self, reload_timeout):
+        expires = self.not_valid_after - datetime.utcnow()
+        return expires <= reload_timeout
+
+    def acquire(self):
+        with self._lock:
+            self._active += 1
+
+    def release(self):
+        with self._lock:
+            self._active -= 1
+            close = self._retired and not self._active
+        if close:
+            self.client.close()
+
+    def retire(self):
+        with self._lock:
+            self._retired = True
+            close = not self._active
+        if close:
+            self.client.close()
+
+
+class _HTTP2RawResponse(object):
+    """A file-like view of an HTTP/2 response body, which stands in for the
+    :class:`urllib3.response.HTTPResponse` that requests normally uses as
+    :attr:`requests.Response.raw`."""
+
+    def __init__(self, response, release):
+        self.status = response.status_code
+        self.reason = response.reason_phrase
+        self.version = 20 if response.http_version == 'HTTP/2' else 11
+        self._response = response
+        self._release = release
+        self._chunks = None
+        self._buffer = b''
+        self._closed = False
+        # requests reads cookies from the headers of the original
+        # http.client response.
+        msg = Message()
+        for key, value in response.headers.multi_items():
+            msg[key] = value
+        self._original_response = self
+        self.msg = msg
+
+    def stream(self, amt=_READ_CHUNK_SIZE, decode_content=True):
+        try:
+            if decode_content:
+                chunks = self._response.iter_bytes(amt)
+            else:
+                chunks = self._response.iter_raw(amt)
+            for chunk in chunks:
+                yield chunk
+        except httpx.RemoteProtocolError as e:
+            raise ChunkedEncodingError(e)
+        except httpx.TransportError as e:
+            raise ConnectionError(e)
+        finally:
+            self.close()
+
+    def read(self, amt=None, decode_content=True):
+        if self._chunks is None:
+            self._chunks = self.stream(decode_content=decode_content)
+        buffers = [self._buffer]
+        size = len(self._buffer)
+        while amt is None or size < amt:
+            chunk = next(self._chunks, b'')
+            if not chunk:
+                break
+            buffers.append(chunk)
+            size += len(chunk)
+        data = b''.join(buffers)
+        if amt is None:
+            self._buffer = b''
+            return data
+        self._buffer = data[amt:]
+        return data[:amt]
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._response.close()
+            self._release()
+
+    release_conn = close
+
+
+class CertReloadingHTTP2Adapter(BaseAdapter):
+    """A transport adapter that multiplexes concurrent requests to each host
+    over a single HTTP/2 connection, and that reloads the client X.509
+    certificate if it is going to expire soon or if it has changed.
+
+    This adapter requires the optional :mod:`httpx` package with HTTP/2
+    support (``pip install httpx[http2]``). Servers that do not support
+    HTTP/2 are spoken to using HTTP/1.1.
+
+    Parameters
+    ----------
+    cert_reload_timeout : int
+        Reload the certificate if it expires within this many seconds from now.
+
+    Notes
+    -----
+    The certificate and key files are checked for changes before every
+    request. When a file changes or the certificate is about to expire, new
+    requests are sent over a new connection that uses the new certificate,
+    and the old connection is closed as soon as the responses that are still
+    using it have been read.
+
+    """
+
+    def __init__(self, cert_reload_timeout=0):
+        if httpx is None:
+            raise ValueError(
+                'http2 requires the httpx package with HTTP/2 support')
+        super(CertReloadingHTTP2Adapter, self).__init__()
+        self._reload_timeout = timedelta(seconds=cert_reload_timeout)
+        self._clients = {}  # (verify, cert, proxy) -> _HTTP2Client
+        self._lock = Lock()
+
+    def _get_client(self, verify, cert, proxy):
+        key = (verify, cert, proxy)
+        identity = _files_identity(verify, cert)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None or client.identity != identity \
+                    or client.has_expired(self._reload_timeout):
+                if client is not None:
+                    client.retire()
+                client = self._clients[key] = _HTTP2Client(
+                    verify, cert, proxy, identity)
+            client.acquire()
+        return client
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        if isinstance(cert, list):
+            cert = tuple(cert)
+        proxy = select_proxy(request.url, proxies or {})
+        client = self._get_client(verify, cert, proxy)
+
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        body = request.body
+        if hasattr(body, 'read'):
+            body = iter(partial(body.read, _READ_CHUNK_SIZE), b'')
+        headers = [(key, value) for key, value in request.headers.items()
+                   if key.lower() not in _HOP_BY_HOP_HEADERS]
+
+        try:
+            response = client.client.send(
+                client.client.build_request(
+                    request.method, request.url, headers=headers,
+                    content=body,
+                    timeout=httpx.Timeout(connect=connect, read=read,
+                                          write=read, pool=connect)),
+                stream=True)
+        except httpx.ConnectTimeout as e:
+            client.release()
+            raise ConnectTimeout(e, request=request)
+        except httpx.TimeoutException as e:
+            client.release()
+            raise ReadTimeout(e, request=request)
+        except httpx.ProxyError as e:
+            client.release()
+            raise ProxyError(e, request=request)
+        except httpx.ConnectError as e:
+            client.release()
+            if isinstance(e.__context__, ssl.SSLError):
+                raise SSLError(e, request=request)
+            raise ConnectionError(e, request=request)
+        except httpx.TransportError as e:
+            client.release()
+            raise ConnectionError(e, request=request)
+        except BaseException:
+            client.release()
+            raise
+
+        return self.build_response(
+            request, _HTTP2RawResponse(response, client.release))
+
+    def build_response(self, req, resp):
+        """Build a :class:`requests.Response` from an HTTP/2 response.
+
+        Parameters
+        ----------
+        req : requests.PreparedRequest
+            The request that was sent.
+        resp : object
+            The raw response.
+
+        Returns
+        -------
+        requests.Response
+            The response.
+
+        """
+        response = Response()
+        response.status_code = resp.status
+        response.headers = CaseInsensitiveDict(
+            (key, resp._response.headers[key])
+            for key in resp._response.headers.keys())
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = resp
+        response.reason = resp.reason
+        if isinstance(req.url, bytes):
+            response.url = req.url.decode('utf-8')
+        else:
+            response.url = req.url
+        extract_cookies_to_jar(response.cookies, req, resp)
+        response.request = req
+        response.connection = self
+        return response
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.retire()
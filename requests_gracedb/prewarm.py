@@ -0,0 +1,122 @@
+#
+# Copyright (C) 2019-2020  Leo P. Singer <leo.singer@ligo.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+import logging
+from threading import Thread
+
+from requests.models import Request
+
+log = logging.getLogger(__name__)
+
+# Maximum time in seconds to wait for a pre-warmed connection to connect.
+_PREWARM_TIMEOUT = 10
+
+
+def _get_pool(adapter, url, verify, cert, proxies):
+    """Get the connection pool that the adapter would use for a request."""
+    if hasattr(adapter, 'get_connection_with_tls_context'):
+        # requests >= 2.32 keys the pools by their TLS settings.
+        pool = adapter.get_connection_with_tls_context(
+            Request('GET', url).prepare(), verify, proxies=proxies, cert=cert)
+    else:
+        pool = adapter.get_connection(url, proxies)
+    adapter.cert_verify(pool, url, verify, cert)
+    return pool
+
+
+def _connect(pool, conn):
+    """Connect a connection that has been taken from a pool, and put it back
+    so that requests can use it."""
+    # Do not let an unreachable host hold up the thread indefinitely.
+    timeout = conn.timeout
+    if not isinstance(timeout, (int, float)) or timeout > _PREWARM_TIMEOUT:
+        conn.timeout = _PREWARM_TIMEOUT
+    try:
+        if conn.sock is None:
+            conn.connect()
+    except Exception as e:
+        log.warning('Failed to pre-warm connection to %s: %s', pool.host, e)
+        conn.close()
+    finally:
+        # urllib3 sets the socket's read timeout for each request.
+        conn.timeout = timeout
+        pool._put_conn(conn)
+
+
+class SessionPrewarmMixin(object):
+    """A mixin for :class:`requests.Session` to open connections to the
+    service ahead of the first request.
+
+    Parameters
+    ----------
+    url : str, optional
+        The URL of the service.
+    prewarm : int, default=0
+        The number of connections to `url` to open and handshake in the
+        background when the session is created. Requests that are made in the
+        meantime use the connections as soon as they are ready.
+
+    Notes
+    -----
+    The connections are established with the credentials and the
+    certificate verification settings that the session has at the end of
+    its construction, including the :envvar:`REQUESTS_CA_BUNDLE` environment
+    variable and proxy environment variables. Connections that cannot be
+    established are silently opened again by the first requests that use
+    them. The adapter that is mounted for the URL must be based on
+    :class:`requests.adapters.HTTPAdapter`; otherwise, no connections are
+    pre-warmed.
+
+    """
+
+    def __init__(self, url=None, prewarm=0, **kwargs):
+        super(SessionPrewarmMixin, self).__init__(url=url, **kwargs)
+        if prewarm < 0:
+            raise ValueError('prewarm must be a non-negative integer.')
+        self._prewarm_threads = []
+        if url is not None and prewarm:
+            thread = Thread(target=self._prewarm, args=(url, prewarm),
+                            name='SessionPrewarm')
+            thread.daemon = True
+            thread.start()
+            self._prewarm_threads.append(thread)
+
+    def _prewarm(self, url, n):
+        try:
+            adapter = self.get_adapter(url)
+            if not hasattr(adapter, 'cert_verify'):
+                return
+            settings = self.merge_environment_settings(
+                url, {}, None, self.verify, self.cert)
+            pool = _get_pool(adapter, url, settings['verify'],
+                             settings['cert'], settings['proxies'])
+            # Take the slots first, so that each thread opens a distinct
+            # connection. There is no point in opening more connections than
+            # the pool can hold.
+            n = min(n, getattr(pool.pool, 'maxsize', n))
+            conns = [pool._get_conn() for _ in range(n)]
+        except Exception as e:
+            log.warning('Failed to pre-warm connections to %s: %s', url, e)
+            return
+        if not conns:
+            return
+        threads = [Thread(target=_connect, args=(pool, conn),
+                          name='SessionPrewarm') for conn in conns[1:]]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self._prewarm_threads.extend(threads)
+        _connect(pool, conns[0])
@@ -16,13 +16,20 @@
 #
 """Tests for :mod:`requests_gracedb.auth`."""
 from __future__ import print_function
+import io
 import os
 import random
 import stat
 
 import pytest
+from requests.adapters import HTTPAdapter
+from requests.auth import _basic_auth_str
+from requests.exceptions import HTTPError
+from safe_netrc import NetrcParseError
 
+from .. import auth
 from .. import Session
+from ..bearer_token import BearerTokenAuth
 
 
 def set_rwx_user(fileobj):
@@ -30,6 +37,13 @@ def set_rwx_user(fileobj):
     os.fchmod(fileobj.fileno(), stat.S_IRWXU)
 
 
+@pytest.fixture(autouse=True)
+def no_bearer_token(monkeypatch):
+    """Make sure that there is no default bearer token."""
+    monkeypatch.delenv('BEARER_TOKEN_FILE', raising=False)
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+
+
 @pytest.fixture
 def x509_cert_and_key(tmpdir):
     """Generate (empty, dummy) X.509 public and private key files."""
@@ -183,6 +197,41 @@ def test_x509_default_globus(monkeypatch, tmpdir, x509up_does_not_exist):
     assert client.cert == tuple(filepaths)
 
 
+def test_token_explicit():
+    """Test bearer token auth provided explicitly."""
+    client = Session('https://example.org/', token=lambda: 'foobar')
+    assert isinstance(client.auth, BearerTokenAuth)
+    assert client.cert is None
+
+
+def test_token_default_env(monkeypatch, tmpdir, x509_proxy):
+    """Test bearer token auth provided through BEARER_TOKEN_FILE, which
+    takes precedence over X.509 auth."""
+    filename = str(tmpdir / 'token')
+    monkeypatch.setenv('BEARER_TOKEN_FILE', filename)
+    monkeypatch.setenv('X509_USER_PROXY', x509_proxy)
+    client = Session('https://example.org/')
+    assert client.auth == BearerTokenAuth(filename)
+    assert client.cert is None
+
+
+def test_token_default_xdg_runtime_dir(monkeypatch, tmpdir,
+                                       x509up_does_not_exist):
+    """Test bearer token auth provided through $XDG_RUNTIME_DIR/bt_u{uid}.
+    """
+    monkeypatch.delenv('X509_USER_CERT', raising=False)
+    monkeypatch.delenv('X509_USER_KEY', raising=False)
+    monkeypatch.delenv('X509_USER_PROXY', raising=False)
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmpdir))
+    filename = str(tmpdir / 'bt_u{}'.format(auth.getuid()))
+    with open(filename, 'w') as f:
+        set_rwx_user(f)
+    client = Session('https://example.org/')
+    assert client.auth == BearerTokenAuth(filename)
+    assert client.cert is None
+
+
 def test_basic_default(monkeypatch, tmpdir, x509up_does_not_exist):
     """Test basic auth provided through a netrc file."""
     filename = str(tmpdir / 'netrc')
@@ -214,3 +263,315 @@ def test_fail_if_noauth(monkeypatch, tmpdir, x509up_does_not_exist):
     assert client.cert is None
     with pytest.raises(ValueError):
         Session('https://example.org/', fail_if_noauth=True)
+
+
+@pytest.fixture
+def count_discovery(monkeypatch):
+    """Count searches for certificates and parses of netrc files."""
+    calls = []
+
+    def wrap(name):
+        func = getattr(auth, name)
+
+        def wrapper(*args):
+            calls.append(name)
+            return func(*args)
+
+        monkeypatch.setattr(auth, name, wrapper)
+
+    wrap('_find_cert')
+    wrap('netrc')
+    monkeypatch.setattr(auth, '_discovery_cache', {})
+    monkeypatch.setattr(auth, '_netrc_index', auth._NetrcIndex())
+    return calls
+
+
+def test_discovery_skipped(count_discovery, x509_cert_and_key):
+    """Test that default credentials are not looked up if they are not
+    needed."""
+    Session('https://example.org/', cert=tuple(x509_cert_and_key))
+    Session('https://example.org/', username='albert.einstein',
+            password='super-secret')
+    client = Session('https://example.org/', force_noauth=True)
+    assert client.cert is None
+    assert client.auth is None
+    assert count_discovery == []
+
+
+def test_discovery_lazy_and_memoized(monkeypatch, tmpdir, count_discovery,
+                                     x509_proxy, x509up_does_not_exist):
+    """Test that default credentials are looked up when they are first used,
+    and only once unless the environment changes."""
+    monkeypatch.setenv('NETRC', str(tmpdir / 'netrc'))
+    monkeypatch.delenv('X509_USER_CERT', raising=False)
+    monkeypatch.delenv('X509_USER_KEY', raising=False)
+    monkeypatch.delenv('X509_USER_PROXY', raising=False)
+    monkeypatch.setenv('HOME', str(tmpdir))
+
+    client = Session('https://example.org/')
+    assert count_discovery == []
+    assert client.cert is None
+    assert client.auth is None
+    assert count_discovery == ['_find_cert', 'netrc']
+
+    # The results are cached for new sessions.
+    del count_discovery[:]
+    client = Session('https://example.org/')
+    assert client.cert is None
+    assert client.auth is None
+    assert count_discovery == []
+
+    # A change in the environment is noticed.
+    monkeypatch.setenv('X509_USER_PROXY', x509_proxy)
+    client = Session('https://example.org/')
+    assert client.cert == x509_proxy
+    assert client.auth is None
+    assert count_discovery == ['_find_cert']
+
+    # So is a new netrc file.
+    monkeypatch.delenv('X509_USER_PROXY')
+    with open(str(tmpdir / 'netrc'), 'w') as f:
+        print('machine', 'example.org', 'login', 'albert.einstein',
+              'password', 'super-secret', file=f)
+        set_rwx_user(f)
+    del count_discovery[:]
+    client = Session('https://example.org/')
+    assert client.auth == ('albert.einstein', 'super-secret')
+    assert count_discovery == ['_find_cert', 'netrc']
+
+
+def test_netrc_index(monkeypatch, tmpdir, count_discovery):
+    """Test looking up hosts in the netrc file."""
+    filename = str(tmpdir / 'netrc')
+    monkeypatch.setenv('NETRC', filename)
+    index = auth._netrc_index
+    assert index.authenticators('example.org') is None
+
+    with open(filename, 'w') as f:
+        print('machine', 'example.org', 'login', 'albert.einstein',
+              'password', 'super-secret', file=f)
+        print('machine', 'example.com', 'login', 'marie.curie',
+              'password', 'radium', file=f)
+        set_rwx_user(f)
+    del count_discovery[:]
+    # Compare only the login and password, because the default account is
+    # an empty string on Python 3 but None on Python 2.
+    assert index.authenticators('example.org')[::2] == (
+        'albert.einstein', 'super-secret')
+    assert index.authenticators('example.com')[::2] == (
+        'marie.curie', 'radium')
+    assert index.authenticators('example.net') is None
+    assert count_discovery == ['netrc']
+
+    # Add a default entry.
+    with open(filename, 'a') as f:
+        print('default', 'login', 'anonymous', 'password', 'guest', file=f)
+    assert index.authenticators('example.net')[::2] == ('anonymous', 'guest')
+    assert count_discovery == ['netrc', 'netrc']
+
+    # The file must only be readable by the user.
+    os.chmod(filename, stat.S_IRUSR | stat.S_IROTH)
+    with pytest.raises(NetrcParseError):
+        index.authenticators('example.org')
+
+
+@pytest.fixture
+def server(socket_enabled):
+    """Run test http server that only accepts the credentials in
+    `server.accepted`, and that rejects the next `server.reject` requests
+    anyway."""
+    pytest_httpserver = pytest.importorskip('pytest_httpserver')
+    from werkzeug.wrappers import Response
+
+    def handler(request):
+        if server.reject:
+            server.reject -= 1
+        elif request.headers.get('Authorization') in server.accepted:
+            return Response('OK')
+        return Response('Unauthorized', status=401)
+
+    with pytest_httpserver.HTTPServer() as server:
+        server.accepted = ()
+        server.reject = 0
+        server.expect_request('/').respond_with_handler(handler)
+        yield server
+
+
+@pytest.fixture
+def no_rediscovery_interval(monkeypatch):
+    """Allow looking for new credentials after every failure."""
+    monkeypatch.setattr(auth, '_REDISCOVERY_INTERVAL', 0)
+
+
+def test_reauth_token(server, tmpdir):
+    """Test reading a renewed token file after an authentication failure."""
+    filename = str(tmpdir / 'token')
+    with open(filename, 'w') as f:
+        print('old-token', file=f)
+    url = server.url_for('/')
+    with Session(url, token=filename) as client:
+        server.accepted = ('Bearer old-token',)
+        assert client.get(url).history == []
+        pool = client.get_adapter(url).get_connection(url)
+
+        with open(filename, 'w') as f:
+            print('new-token', file=f)
+        server.accepted = ('Bearer new-token',)
+        response = client.get(url)
+        assert [r.status_code for r in response.history] == [401]
+        assert response.request.headers['Authorization'] == 'Bearer new-token'
+        assert client.get(url).history == []
+
+        # The connection pool was kept.
+        assert client.get_adapter(url).get_connection(url) is pool
+
+
+def test_reauth_netrc(monkeypatch, tmpdir, server, x509up_does_not_exist,
+                      no_rediscovery_interval):
+    """Test looking for new default credentials after an authentication
+    failure."""
+    filename = str(tmpdir / 'netrc')
+    monkeypatch.setenv('NETRC', filename)
+    monkeypatch.delenv('X509_USER_CERT', raising=False)
+    monkeypatch.delenv('X509_USER_KEY', raising=False)
+    monkeypatch.delenv('X509_USER_PROXY', raising=False)
+    monkeypatch.setenv('HOME', str(tmpdir))
+    with open(filename, 'w') as f:
+        print('machine', 'localhost', 'login', 'albert.einstein',
+              'password', 'old-secret', file=f)
+        set_rwx_user(f)
+    url = server.url_for('/')
+    with Session(url) as client:
+        with pytest.raises(HTTPError):
+            client.get(url)
+        assert client.auth == ('albert.einstein', 'old-secret')
+
+        with open(filename, 'w') as f:
+            print('machine', 'localhost', 'login', 'albert.einstein',
+                  'password', 'new-secret', file=f)
+        server.accepted = (_basic_auth_str('albert.einstein', 'new-secret'),)
+        assert [r.status_code for r in client.get(url).history] == [401]
+        assert client.auth == ('albert.einstein', 'new-secret')
+
+
+def test_reauth_cert(monkeypatch, tmpdir, server, no_rediscovery_interval):
+    """Test reopening connections with a new client certificate after an
+    authentication failure."""
+    proxies = [str(tmpdir / 'proxy{}.pem'.format(i)) for i in range(2)]
+    for proxy in proxies:
+        with open(proxy, 'wb') as f:
+            set_rwx_user(f)
+    monkeypatch.setenv('X509_USER_PROXY', proxies[0])
+    url = server.url_for('/')
+    with Session(url) as client:
+        assert client.cert == proxies[0]
+        server.accepted = (None,)
+        assert client.get(url).history == []
+        pool = client.get_adapter(url).get_connection(url)
+
+        # The server cannot tell the certificates apart over plain HTTP, so
+        # just reject the next request.
+        monkeypatch.setenv('X509_USER_PROXY', proxies[1])
+        server.reject = 1
+        response = client.get(url)
+        assert [r.status_code for r in response.history] == [401]
+        assert client.cert == proxies[1]
+        assert client.get_adapter(url).get_connection(url) is not pool
+
+
+def test_per_host_credentials(monkeypatch, tmpdir, server,
+                              x509up_does_not_exist):
+    """Test looking up default credentials for each host."""
+    filename = str(tmpdir / 'netrc')
+    with open(filename, 'w') as f:
+        print('machine', 'localhost', 'login', 'albert.einstein',
+              'password', 'super-secret', file=f)
+        print('machine', '127.0.0.1', 'login', 'marie.curie',
+              'password', 'radium', file=f)
+        set_rwx_user(f)
+    monkeypatch.setenv('NETRC', filename)
+    monkeypatch.delenv('X509_USER_CERT', raising=False)
+    monkeypatch.delenv('X509_USER_KEY', raising=False)
+    monkeypatch.delenv('X509_USER_PROXY', raising=False)
+    monkeypatch.setenv('HOME', str(tmpdir))
+    calls = []
+    find_username_password = auth._find_username_password
+
+    def wrapper(url):
+        calls.append(url)
+        return find_username_password(url)
+
+    monkeypatch.setattr(auth, '_find_username_password', wrapper)
+    server.accepted = (_basic_auth_str('albert.einstein', 'super-secret'),
+                       _basic_auth_str('marie.curie', 'radium'))
+    url = server.url_for('/')
+    other_url = 'http://127.0.0.1:{}/'.format(server.port)
+    with Session(url) as client:
+        for _ in range(2):
+            for request_url in (url, other_url):
+                client.get(request_url)
+        assert client.auth == ('albert.einstein', 'super-secret')
+        assert len(calls) == 2
+
+    assert [request.authorization.username
+            for request, _ in server.log] == [
+        'albert.einstein', 'marie.curie', 'albert.einstein', 'marie.curie']
+
+
+def test_per_host_credentials_explicit(server):
+    """Test that explicitly provided credentials are used for all hosts."""
+    server.accepted = (_basic_auth_str('albert.einstein', 'super-secret'),)
+    url = server.url_for('/')
+    other_url = 'http://127.0.0.1:{}/'.format(server.port)
+    with Session(url, username='albert.einstein',
+                 password='super-secret') as client:
+        client.get(url)
+        client.get(other_url)
+
+
+def test_reauth_rate_limited(server, monkeypatch):
+    """Test that new credentials are looked up at most once in a while, and
+    that requests are not sent again if the credentials did not change."""
+    calls = []
+
+    def fetch():
+        calls.append(None)
+        return 'token-{}'.format(len(calls))
+
+    url = server.url_for('/')
+    with Session(url, token=fetch) as client:
+        with pytest.raises(HTTPError):
+            client.get(url)
+        assert calls == [None, None]
+        with pytest.raises(HTTPError):
+            client.get(url)
+        assert calls == [None, None]
+    assert len(server.log) == 3
+
+
+def test_reauth_unrewindable(server, no_rediscovery_interval):
+    """Test that requests with streamed bodies are not sent again."""
+    calls = []
+
+    def fetch():
+        calls.append(None)
+        return 'token-{}'.format(len(calls))
+
+    url = server.url_for('/')
+    server.accepted = ('Bearer token-2',)
+    with Session(url, token=fetch) as client:
+        with pytest.raises(HTTPError):
+            client.post(url, data=iter([b'foo', b'bar']))
+        assert len(server.log) == 1
+        assert client.post(url, data=b'foobar').history
+        assert client.post(url, data=io.BytesIO(b'foobar')).history == []
+
+
+def test_clear_pools():
+    """Test closing the connection pools for only one host."""
+    adapter = HTTPAdapter()
+    pool1 = adapter.get_connection('https://example.org/')
+    pool2 = adapter.get_connection('https://example.com/')
+    auth._clear_pools(adapter, 'https://EXAMPLE.org:443/foo')
+    assert adapter.get_connection('https://example.org/') is not pool1
+    assert adapter.get_connection('https://example.com/') is pool2
@@ -0,0 +1,158 @@
+#
+# Copyright (C) 2019-2020  Leo P. Singer <leo.singer@ligo.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests for :mod:`requests_gracedb.bearer_token`."""
+from __future__ import print_function
+from base64 import urlsafe_b64encode
+import json
+from threading import Event, Thread
+from time import sleep, time
+
+import pytest
+import requests
+
+from .. import Session
+from ..bearer_token import _get_expiration, _TokenCache, BearerTokenAuth
+
+# FIXME: Python 2
+pytest_httpserver = pytest.importorskip('pytest_httpserver')
+
+
+def make_token(exp, subject='albert.einstein'):
+    """Make an (unsigned) JSON Web Token."""
+    return '.'.join(
+        urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip('=')
+        for part in ({'alg': 'none'}, {'sub': subject, 'exp': exp})) + '.'
+
+
+def write_token_file(filename, token):
+    with open(filename, 'w') as f:
+        print(token, file=f)
+
+
+def test_get_expiration():
+    """Test reading the expiration time of a token."""
+    assert _get_expiration(make_token(1234567890)) == 1234567890
+    assert _get_expiration('not-a-jwt') is None
+    assert _get_expiration('not.a.jwt') is None
+
+
+def test_token_file(tmpdir):
+    """Test reading the token from a file, and reading the file again when
+    the token expires."""
+    filename = str(tmpdir / 'token')
+    old_token = make_token(time() - 1)
+    write_token_file(filename, old_token)
+    client = Session('https://example.org/', token=filename)
+    assert client.auth == BearerTokenAuth(filename)
+    assert client.cert is None
+
+    request = client.prepare_request(
+        requests.Request('GET', 'https://example.org/'))
+    assert request.headers['Authorization'] == 'Bearer ' + old_token
+
+    new_token = make_token(time() + 3600)
+    write_token_file(filename, new_token)
+    for _ in range(2):
+        request = client.prepare_request(
+            requests.Request('GET', 'https://example.org/'))
+        assert request.headers['Authorization'] == 'Bearer ' + new_token
+
+
+def test_token_endpoint(socket_enabled):
+    """Test fetching tokens from a stand-in token endpoint."""
+    token = make_token(time() + 3600)
+    with pytest_httpserver.HTTPServer(threaded=True) as server:
+        server.expect_request('/token').respond_with_data(token)
+        server.expect_request(
+            '/', headers={'Authorization': 'Bearer ' + token}
+        ).respond_with_json({'foo': 'bar'})
+
+        def fetch():
+            return requests.get(server.url_for('/token')).text
+
+        with Session(server.url_for('/'), token=fetch) as client:
+            for _ in range(3):
+                assert client.get(server.url_for('/')).json() == {
+                    'foo': 'bar'}
+        assert len(server.log) == 4
+
+
+def test_token_refresh_in_background():
+    """Test that tokens are refreshed before they expire."""
+    tokens = []
+
+    def fetch():
+        # The first token is valid for one second, and the next for an hour.
+        tokens.append(make_token(time() + (3600 if tokens else 1),
+                                 'user{}'.format(len(tokens))))
+        return tokens[-1]
+
+    cache = _TokenCache(fetch)
+    assert cache.get() == tokens[0]
+    assert cache.get() == tokens[0]
+    assert len(tokens) == 1
+
+    # The token is about to expire: keep using it while it is refreshed.
+    sleep(0.6)
+    assert cache.get() == tokens[0]
+    for _ in range(50):
+        if len(tokens) == 2:
+            break
+        sleep(0.1)
+    assert len(tokens) == 2
+    for _ in range(50):
+        token = cache.get()
+        if token == tokens[1]:
+            break
+        sleep(0.1)
+    assert token == tokens[1]
+
+    assert len(tokens) == 2
+
+
+def test_token_single_flight():
+    """Test that only one thread fetches the token at a time."""
+    calls = []
+    event = Event()
+    token = make_token(time() + 3600)
+
+    def fetch():
+        calls.append(None)
+        event.wait(5)
+        return token
+
+    cache = _TokenCache(fetch)
+    results = []
+    threads = [Thread(target=lambda: results.append(cache.get()))
+               for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    sleep(0.2)
+    event.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [token] * 16
+
+
+def test_token_fetch_error():
+    """Test that errors while fetching a token are raised."""
+    def fetch():
+        raise RuntimeError('token endpoint is down')
+
+    with pytest.raises(RuntimeError):
+        _TokenCache(fetch).get()
@@ -17,7 +17,11 @@
 """Tests for :mod:`requests_gracedb.cert_reload`."""
 from __future__ import absolute_import
 from datetime import datetime
+import gc
+import os
+import socket
 from ssl import SSLContext
+import time
 
 from cryptography.x509 import (
     CertificateBuilder, DNSName, Name, NameAttribute, random_serial_number,
@@ -29,8 +33,11 @@ from cryptography.hazmat.primitives.serialization import (
     Encoding, NoEncryption, PrivateFormat)
 from cryptography.hazmat.primitives.hashes import SHA256
 import pytest
+from requests.packages.urllib3 import connectionpool
+from requests.packages.urllib3.exceptions import EmptyPoolError
 import six
 
+from .. import cert_reload
 from .. import Session
 
 # FIXME: Python 2
@@ -55,9 +62,8 @@ def server_key(backend):
     return generate_private_key(65537, 2048, backend)
 
 
-@pytest.fixture
-def client_cert(client_key, backend):
-    """Generate client certificate."""
+def make_client_cert(client_key, backend, not_valid_after):
+    """Generate client certificate that expires at the given time."""
     subject = issuer = Name([
         NameAttribute(NameOID.COMMON_NAME, six.u('example.org')),
         NameAttribute(NameOID.ORGANIZATION_NAME, six.u('Alice A. Client'))
@@ -73,7 +79,7 @@ def client_cert(client_key, backend):
     ).not_valid_before(
         datetime(3019, 1, 1)
     ).not_valid_after(
-        datetime(3019, 1, 10)
+        not_valid_after
     ).add_extension(
         SubjectAlternativeName([DNSName(six.u('localhost'))]),
         critical=False
@@ -82,6 +88,12 @@ def client_cert(client_key, backend):
     )
 
 
+@pytest.fixture
+def client_cert(client_key, backend):
+    """Generate client certificate."""
+    return make_client_cert(client_key, backend, datetime(3019, 1, 10))
+
+
 @pytest.fixture
 def server_cert(server_key, backend):
     """Generate server certificate."""
@@ -192,3 +204,430 @@ def test_cert_reload(client, server, freezer):
     conn3 = pool3.pool.queue[-1]
     assert pool1 is pool3
     assert conn1 is not conn3
+
+
+def test_cert_cache(monkeypatch, client_cert_file, client_key, backend):
+    """Test that certificates are parsed again only if the file changes."""
+    filenames = []
+    load_x509_certificate = cert_reload.load_x509_certificate
+
+    def mock_load_x509_certificate(filename):
+        filenames.append(filename)
+        return load_x509_certificate(filename)
+
+    monkeypatch.setattr(cert_reload, 'load_x509_certificate',
+                        mock_load_x509_certificate)
+
+    for _ in range(3):
+        assert cert_reload._get_not_valid_after(
+            client_cert_file) == datetime(3019, 1, 10)
+    assert filenames == [client_cert_file]
+
+    new_cert = make_client_cert(client_key, backend, datetime(3019, 2, 10))
+    with open(client_cert_file, 'wb') as f:
+        f.write(new_cert.public_bytes(Encoding.PEM))
+    os.utime(client_cert_file, (0, 0))
+    for _ in range(3):
+        assert cert_reload._get_not_valid_after(
+            client_cert_file) == datetime(3019, 2, 10)
+    assert filenames == [client_cert_file] * 2
+    assert len([key for key in cert_reload._cert_cache
+                if key[0] == client_cert_file]) == 1
+
+
+def test_ssl_context_cache(monkeypatch, client, server, client_cert_file,
+                           client_key, backend):
+    """Test that SSL contexts are shared until the certificate changes."""
+    calls = []
+    build_ssl_context = cert_reload._build_ssl_context
+
+    def mock_build_ssl_context(*args):
+        calls.append(args)
+        return build_ssl_context(*args)
+
+    monkeypatch.setattr(cert_reload, '_build_ssl_context',
+                        mock_build_ssl_context)
+    monkeypatch.setattr(cert_reload, '_ssl_context_cache',
+                        cert_reload.OrderedDict())
+
+    url = server.url_for('/')
+    assert client.get(url).json() == {'foo': 'bar'}
+    pool = client.get_adapter(url=url).poolmanager.connection_from_url(url)
+    conn1 = pool.pool.queue[-1]
+    conn2 = pool._new_conn()
+    conn2.connect()
+    assert len(calls) == 1
+    assert conn1.ssl_context is conn2.ssl_context
+    assert conn2.cert_file == client_cert_file
+    conn2.close()
+
+    new_cert = make_client_cert(client_key, backend, datetime(3019, 2, 10))
+    with open(client_cert_file, 'wb') as f:
+        f.write(new_cert.public_bytes(Encoding.PEM))
+    os.utime(client_cert_file, (0, 0))
+    conn3 = pool._new_conn()
+    conn3.connect()
+    assert len(calls) == 2
+    assert conn3.ssl_context is not conn1.ssl_context
+    assert len(cert_reload._ssl_context_cache) == 1
+    conn3.close()
+
+
+def test_ssl_context_requests_default(monkeypatch, client, server,
+                                      server_cert_file):
+    """Test that requests' process-wide default SSL context is not used, so
+    that the client certificate is not loaded into it."""
+    preloaded = SSLContext()
+    monkeypatch.setattr('requests.adapters._preloaded_ssl_context', preloaded,
+                        raising=False)
+    monkeypatch.setattr(cert_reload, 'DEFAULT_CA_BUNDLE_PATH',
+                        server_cert_file)
+    url = server.url_for('/')
+    adapter = client.get_adapter(url=url)
+    # This is what requests >= 2.32 does for verify=True.
+    pool = adapter.poolmanager.connection_from_url(
+        url, pool_kwargs={'ssl_context': preloaded, 'cert_reqs': 'REQUIRED'})
+    conn = pool._new_conn()
+    assert conn.ssl_context is None
+    conn.connect()
+    try:
+        assert conn.ssl_context is not preloaded
+        assert conn.ssl_context is cert_reload._get_ssl_context(
+            conn.cert_file, conn.key_file, server_cert_file, None,
+            'REQUIRED', None)
+    finally:
+        conn.close()
+
+
+def close_idle_conns(pool):
+    """Close the idle connections of a pool."""
+    for conn in pool.pool.queue:
+        if conn is not None:
+            conn.close()
+
+
+@pytest.mark.skipif(not cert_reload._HAS_TLS_SESSIONS,
+                    reason='TLS session resumption is not supported')
+def test_tls_session_resumption(client, server, client_cert_file,
+                                client_key, backend):
+    """Test that new connections resume the TLS session of old ones."""
+    url = server.url_for('/')
+    adapter = client.get_adapter(url=url)
+    assert client.get(url).json() == {'foo': 'bar'}
+    assert adapter.tls_session_hits == 0
+    assert adapter.tls_session_misses == 1
+
+    # Force the next request to open a new connection.
+    pool = adapter.poolmanager.connection_from_url(url)
+    close_idle_conns(pool)
+    assert client.get(url).json() == {'foo': 'bar'}
+    assert adapter.tls_session_hits == 1
+    assert adapter.tls_session_misses == 1
+
+    # Changing the certificate discards the sessions.
+    new_cert = make_client_cert(client_key, backend, datetime(3019, 2, 10))
+    with open(client_cert_file, 'wb') as f:
+        f.write(new_cert.public_bytes(Encoding.PEM))
+    os.utime(client_cert_file, (0, 0))
+    close_idle_conns(pool)
+    assert client.get(url).json() == {'foo': 'bar'}
+    assert adapter.tls_session_hits == 1
+    assert adapter.tls_session_misses == 2
+
+
+def test_pool_stats(monkeypatch, client, server):
+    """Test connection pool statistics."""
+    url = server.url_for('/')
+    adapter = client.get_adapter(url=url)
+    pool = adapter.poolmanager.connection_from_url(url)
+    stats = adapter.pool_stats()
+    assert stats['connections_opened'] == 0
+    assert stats['handshake_time']['count'] == 0
+
+    assert client.get(url).json() == {'foo': 'bar'}
+    stats = adapter.pool_stats()
+    assert stats['connections_opened'] == 1
+    assert stats['handshake_time']['count'] == 1
+    assert stats['handshake_time']['sum'] > 0
+    assert sum(n for _, n in stats['handshake_time']['buckets']) == 1
+    assert stats == adapter.pool_stats(url)
+    assert stats == pool.stats.snapshot()
+
+    # Reuse the idle connection. The test server closes connections after
+    # each response, and would send TLS 1.3 session tickets that make an idle
+    # connection look as if it was dropped, so pretend that it is alive.
+    monkeypatch.setattr(connectionpool, 'is_connection_dropped',
+                        lambda conn: False)
+    conn = pool._get_conn()
+    if conn.sock is None:
+        conn.connect()
+    reused = adapter.pool_stats()['connections_reused']
+    pool._put_conn(conn)
+    assert pool._get_conn() is conn
+    assert adapter.pool_stats()['connections_reused'] == reused + 1
+
+    # Expire the connection.
+    conn._not_valid_after = datetime.utcnow()
+    pool._put_conn(conn)
+    pool._close_stale_conns()
+    assert conn.sock is None
+    assert adapter.pool_stats()['connections_expired'] == 1
+
+    # Wait for a free connection in a blocking pool.
+    pool.block = True
+    conns = [pool._get_conn() for _ in range(pool.pool.maxsize)]
+    assert pool.pool.empty()
+    with pytest.raises(EmptyPoolError):
+        pool._get_conn(timeout=0.01)
+    for conn in conns:
+        pool._put_conn(conn)
+    stats = adapter.pool_stats()
+    assert stats['pool_waits'] == 1
+    assert stats['pool_wait_time']['sum'] >= 0.01
+
+
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_pool_adaptive(adaptive):
+    """Test growing and shrinking connection pools."""
+    url = 'https://localhost:1/'
+    client = Session(url, cert_reload=True, pool_maxsize=2,
+                     pool_adaptive=adaptive)
+    adapter = client.get_adapter(url=url)
+    pool = adapter.poolmanager.connection_from_url(url)
+    assert pool.pool.maxsize == 2
+
+    # Use three connections at once.
+    conns = [pool._get_conn() for _ in range(3)]
+    for conn in conns:
+        pool._put_conn(conn)
+    if adaptive:
+        assert pool.pool.maxsize == 3
+        assert list(pool.pool.queue) == conns
+        assert adapter.pool_stats()['connections_discarded'] == 0
+    else:
+        assert pool.pool.maxsize == 2
+        assert list(pool.pool.queue) == conns[:2]
+        assert adapter.pool_stats()['connections_discarded'] == 1
+        return
+
+    # The pool keeps its size as long as that many connections were in use.
+    pool._next_resize = 0
+    pool._put_conn(pool._get_conn())
+    assert pool.pool.maxsize == 3
+
+    # Then it shrinks back to its initial size, dropping the least recently
+    # used connection.
+    pool._next_resize = 0
+    pool._put_conn(pool._get_conn())
+    assert pool.pool.maxsize == 2
+    assert list(pool.pool.queue) == [conns[1], conns[2]]
+
+
+def test_pool_adaptive_requires_cert_reload():
+    """Test that adaptive pools require certificate reloading."""
+    with pytest.raises(ValueError):
+        Session(pool_adaptive=True)
+
+
+def wait_for(condition, timeout=5):
+    """Wait for a condition to become true."""
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_cert_expiry_reaper(server, client_cert_file, client_key_file,
+                            server_cert_file):
+    """Test that idle connections are closed in the background when their
+    certificates are about to expire."""
+    url = server.url_for('/')
+    cert = (client_cert_file, client_key_file)
+    # Make the certificate due for reloading in one second.
+    timeout = (datetime(3019, 1, 10) - datetime.utcnow()).total_seconds() - 1
+    with Session(url, cert=cert, cert_reload=True,
+                 cert_reload_timeout=timeout) as client:
+        client.verify = server_cert_file
+        assert client.get(url).json() == {'foo': 'bar'}
+        pool = client.get_adapter(url=url).poolmanager.connection_from_url(url)
+        conn = pool.pool.queue[-1]
+        assert conn is not None
+
+        # The idle connection is closed without making a request.
+        wait_for(lambda: pool.pool.queue[-1] is None)
+        assert conn.sock is None
+
+
+def test_cert_expiry_checkout(monkeypatch, client, server):
+    """Test that checking out a connection does not wait for expired
+    connections to be closed."""
+    url = server.url_for('/')
+    assert client.get(url).json() == {'foo': 'bar'}
+    pool = client.get_adapter(url=url).poolmanager.connection_from_url(url)
+    conn1 = pool.pool.queue[-1]
+    conn1._not_valid_after = datetime.utcnow()
+    closing = []
+    monkeypatch.setattr(cert_reload._reaper, 'close_later', closing.append)
+    try:
+        conn2 = pool._get_conn()
+        assert conn2 is not conn1
+        assert closing == [conn1]
+        pool._put_conn(conn2)
+    finally:
+        conn1.close()
+
+
+@pytest.mark.parametrize('inotify', [True, False])
+def test_cert_watch(monkeypatch, server, client_cert_file, client_key_file,
+                    server_cert_file, client_key, backend, inotify):
+    """Test reloading client X.509 certificates when the files change."""
+    if not inotify:
+        def no_inotify():
+            raise OSError('inotify is not available')
+
+        monkeypatch.setattr(cert_reload, '_Inotify', no_inotify)
+    url = server.url_for('/')
+    cert = (client_cert_file, client_key_file)
+    with Session(url, cert=cert, cert_reload=True, cert_reload_watch=True,
+                 cert_reload_timeout=0) as client:
+        client.verify = server_cert_file
+        adapter = client.get_adapter(url=url)
+        watcher = adapter._cert_watcher
+        # With inotify, the watcher should wake up without polling.
+        watcher.interval = 60 if inotify else 0.05
+
+        assert client.get(url).json() == {'foo': 'bar'}
+        if inotify and watcher._inotify is None:
+            pytest.skip('inotify is not available')
+        pool = adapter.poolmanager.connection_from_url(url)
+        conn1 = pool.pool.queue[-1]
+        assert conn1 is not None
+        generation = watcher.generation
+
+        # Renew the certificate by renaming a new file over the old one.
+        new_cert = make_client_cert(client_key, backend, datetime(3019, 2, 10))
+        tmp_file = client_cert_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(new_cert.public_bytes(Encoding.PEM))
+        os.rename(tmp_file, client_cert_file)
+
+        # The idle connection is closed without making a request.
+        wait_for(lambda: watcher.generation > generation)
+        wait_for(lambda: pool.pool.queue[-1] is None)
+
+        assert client.get(url).json() == {'foo': 'bar'}
+        conn2 = pool.pool.queue[-1]
+        assert conn2 is not None
+        assert conn2 is not conn1
+
+
+def test_cert_rollover(server, client_cert_file, client_key_file,
+                       server_cert_file, client_key, backend):
+    """Test swapping in pre-warmed connections when the certificate changes."""
+    url = server.url_for('/')
+    cert = (client_cert_file, client_key_file)
+    with Session(url, cert=cert, cert_reload=True, cert_reload_rollover=True,
+                 cert_reload_timeout=0) as client:
+        client.verify = server_cert_file
+        adapter = client.get_adapter(url=url)
+        watcher = adapter._cert_watcher
+        watcher.interval = 0.05
+
+        assert client.get(url).json() == {'foo': 'bar'}
+        pool = adapter.poolmanager.connection_from_url(url)
+        conn1 = pool.pool.queue[-1]
+        assert conn1 is not None
+        generation = watcher.generation
+
+        # Renew the certificate by renaming a new file over the old one.
+        new_cert = make_client_cert(client_key, backend, datetime(3019, 2, 10))
+        tmp_file = client_cert_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(new_cert.public_bytes(Encoding.PEM))
+        os.rename(tmp_file, client_cert_file)
+
+        # The idle connection is replaced by one that is already connected.
+        wait_for(lambda: watcher.generation > generation)
+        wait_for(lambda: pool.pool.queue[-1] is not conn1)
+        conn2 = pool.pool.queue[-1]
+        assert conn2 is not None
+        assert conn2.sock is not None
+        assert conn1.sock is None
+
+        # The next request uses the pre-warmed connection.
+        num_connections = pool.num_connections
+        assert client.get(url).json() == {'foo': 'bar'}
+        assert pool.num_connections == num_connections
+        assert pool.pool.queue[-1] is conn2
+
+
+def test_cert_rollover_timeout(monkeypatch, client, server):
+    """Test that pre-warmed connections are opened with a bounded timeout."""
+    url = server.url_for('/')
+    assert client.get(url).json() == {'foo': 'bar'}
+    pool = client.get_adapter(url=url).poolmanager.connection_from_url(url)
+    timeouts = []
+
+    def connect(self):
+        timeouts.append(self.timeout)
+        raise socket.timeout('timed out')
+
+    monkeypatch.setattr(cert_reload, '_PREWARM_TIMEOUT', 0.5)
+    monkeypatch.setattr(cert_reload._CertReloadingHTTPSConnection, 'connect',
+                        connect)
+    assert pool._prewarm_conns(1) == []
+    assert timeouts == [0.5]
+
+
+def test_cert_watch_error(monkeypatch, server, client_cert_file,
+                          client_key_file, server_cert_file, client_key,
+                          backend):
+    """Test that the watcher keeps running after an unexpected error."""
+    url = server.url_for('/')
+    cert = (client_cert_file, client_key_file)
+    with Session(url, cert=cert, cert_reload=True, cert_reload_watch=True,
+                 cert_reload_timeout=0) as client:
+        client.verify = server_cert_file
+        watcher = client.get_adapter(url=url)._cert_watcher
+        watcher.interval = 0.05
+        errors = []
+        check = watcher._check
+
+        def flaky_check():
+            if not errors:
+                errors.append(None)
+                raise RuntimeError('unexpected error')
+            return check()
+
+        monkeypatch.setattr(watcher, '_check', flaky_check)
+        assert client.get(url).json() == {'foo': 'bar'}
+        wait_for(lambda: errors)
+        generation = watcher.generation
+
+        new_cert = make_client_cert(client_key, backend, datetime(3019, 2, 10))
+        tmp_file = client_cert_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(new_cert.public_bytes(Encoding.PEM))
+        os.rename(tmp_file, client_cert_file)
+        wait_for(lambda: watcher.generation > generation)
+        assert watcher._thread.is_alive()
+
+
+def test_cert_watch_garbage_collected(server, client_cert_file,
+                                      client_key_file, server_cert_file):
+    """Test that the watcher thread exits when its session is garbage
+    collected without being closed."""
+    url = server.url_for('/')
+    cert = (client_cert_file, client_key_file)
+    client = Session(url, cert=cert, cert_reload=True, cert_reload_watch=True)
+    client.verify = server_cert_file
+    watcher = client.get_adapter(url=url)._cert_watcher
+    watcher.interval = 0.05
+    assert client.get(url).json() == {'foo': 'bar'}
+    thread = watcher._thread
+    assert thread.is_alive()
+
+    del client
+    gc.collect()
+    wait_for(lambda: not thread.is_alive())
+    assert watcher._inotify is None
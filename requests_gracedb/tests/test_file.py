@@ -16,7 +16,12 @@
 #
 """Tests for :mod:`requests_gracedb.file`."""
 from __future__ import absolute_import
-from mimetypes import guess_type
+import gzip
+import io
+import os
+import threading
+import time
+import zlib
 try:
     from unittest.mock import Mock
 except ImportError:  # FIXME: Python 2
@@ -24,8 +29,16 @@ except ImportError:  # FIXME: Python 2
 
 import requests
 import pytest
+import six
 
 from .. import Session
+from ..file import UploadProgress
+
+
+# FIXME: Python 2
+requires_mmap = pytest.mark.skipif(
+    six.PY2, reason="upload_mode='mmap' requires Python 3")
+STREAM_UPLOAD_MODES = ['stream', pytest.param('mmap', marks=requires_mmap)]
 
 
 @pytest.fixture
@@ -38,9 +51,7 @@ def mock_request(monkeypatch):
 
 def test_filename_and_contents(mock_request, tmpdir):
     """Test handling of various styles of POSTed files."""
-    # Different operating systems return different MIME types for *.xml files:
-    # application/xml on macOS, text/xml on Linux.
-    xml_mime_type, _ = guess_type('example.xml')
+    xml_mime_type = 'application/xml'
 
     client = Session('https://example.org/')
     filename = str(tmpdir / 'coinc.xml')
@@ -62,3 +73,565 @@ def test_filename_and_contents(mock_request, tmpdir):
         file_expected = ('coinc.xml', fileobj, xml_mime_type)
         client.post('https://example.org/', files={'key': file_in})
         assert mock_request.call_args[1]['files'] == [('key', file_expected)]
+
+
+@pytest.mark.parametrize('filename,content,expected', [
+    ['skymap.fits', b'', 'application/fits'],
+    ['bayestar.multiorder.FITS', b'', 'application/fits'],
+    ['bayestar.fits.gz', b'', 'application/gzip'],
+    ['posterior_samples.hdf5', b'', 'application/x-hdf5'],
+    ['psd.xml.gz', b'', 'application/gzip'],
+    ['coinc.xml', b'<?xml version="1.0"?>', 'application/xml'],
+    ['skymap', b'SIMPLE  =                    T', 'application/fits'],
+    ['samples', b'\x89HDF\r\n\x1a\n\x00', 'application/x-hdf5'],
+    ['voevent', b'<?xml version="1.0"?><voe:VOEvent>', 'application/xml'],
+    ['plot.png', b'not really a PNG', 'image/png'],
+    ['unknown', b'\x00\x01\x02', 'application/octet-stream'],
+    ['unknown', b'', 'application/octet-stream'],
+])
+def test_guess_content_type(mock_request, filename, content, expected):
+    """Test guessing MIME types from file extensions and content."""
+    client = Session('https://example.org/')
+    client.post('https://example.org/', files={'key': (filename, content)})
+    (key, (_, _, content_type)), = mock_request.call_args[1]['files']
+    assert content_type == expected
+
+
+@pytest.mark.parametrize('upload_mode', STREAM_UPLOAD_MODES)
+@pytest.mark.parametrize('data', [None, {'comment': 'hi', 'tags': ['a', 'b']}])
+def test_stream(mock_request, monkeypatch, tmpdir, data, upload_mode):
+    """Test that streamed request bodies match buffered request bodies."""
+    filename = str(tmpdir / 'coinc.xml')
+    filecontent = b'<!--example data-->' * 100
+    with open(filename, 'wb') as f:
+        f.write(filecontent)
+    files = {'key1': (filename, None), 'key2': ('foo.txt', b'bar')}
+
+    client = Session('https://example.org/', upload_mode=upload_mode,
+                     upload_chunk_size=16)
+    client.post('https://example.org/', data=data, files=files)
+    kwargs = mock_request.call_args[1]
+    assert kwargs['files'] is None
+    body = kwargs['data']
+    content_type = kwargs['headers']['Content-Type']
+    assert content_type == body.content_type
+    chunks = [bytes(chunk) for chunk in body]
+    streamed = b''.join(chunks)
+    assert len(streamed) == body.len
+    segments = [s for s in body._segments if isinstance(s, bytes)]
+    assert all(len(chunk) <= 16 for chunk in chunks if chunk not in segments)
+
+    # Encode the same request with requests, using the same boundary.
+    boundary = content_type.split('boundary=')[1]
+    monkeypatch.setattr('urllib3.filepost.choose_boundary', lambda: boundary)
+    client = Session('https://example.org/')
+    client.post('https://example.org/', data=data, files=files)
+    kwargs = mock_request.call_args[1]
+    expected = requests.Request(
+        'POST', 'https://example.org/', data=data,
+        files=kwargs['files']).prepare()
+    assert streamed == expected.body
+    assert content_type == expected.headers['Content-Type']
+
+
+@pytest.mark.skipif(not six.PY2, reason='only applies to Python 2')
+def test_mmap_python2():
+    """Test that the mmap upload mode is rejected on Python 2."""
+    with pytest.raises(ValueError):
+        Session('https://example.org/', upload_mode='mmap')
+
+
+def test_stream_read(mock_request, tmpdir):
+    """Test reading a streamed request body like a file, as Python 2's
+    httplib does."""
+    filename = str(tmpdir / 'coinc.xml')
+    with open(filename, 'wb') as f:
+        f.write(b'<!--example data-->' * 100)
+    client = Session('https://example.org/', upload_mode='stream',
+                     upload_chunk_size=16)
+    client.post('https://example.org/', data={'comment': 'hi'},
+                files={'key1': (filename, None), 'key2': ('foo.txt', b'bar')})
+    body = mock_request.call_args[1]['data']
+    expected = b''.join(bytes(chunk) for chunk in body)
+    pieces = list(iter(lambda: body._read(100), b''))
+    assert all(len(piece) == 100 for piece in pieces[:-1])
+    assert b''.join(pieces) == expected
+    assert body._read() == b''
+
+
+def test_stream_invalid_mode():
+    """Test that an unknown upload mode is an error."""
+    with pytest.raises(ValueError):
+        Session('https://example.org/', upload_mode='invalid')
+    with pytest.raises(ValueError):
+        Session('https://example.org/').post(
+            'https://example.org/', upload_mode='invalid')
+
+
+@pytest.mark.parametrize('upload_mode', STREAM_UPLOAD_MODES)
+def test_stream_upload(socket_enabled, tmpdir, upload_mode):
+    """Test sending a streamed request body to a server."""
+    # FIXME: Python 2
+    pytest_httpserver = pytest.importorskip('pytest_httpserver')
+    from werkzeug.wrappers import Response
+
+    filename = str(tmpdir / 'coinc.xml')
+    filecontent = b'<!--example data-->' * 10000
+    with open(filename, 'wb') as f:
+        f.write(filecontent)
+
+    def handler(request):
+        assert request.content_length == len(request.get_data())
+        assert request.form['comment'] == 'hi'
+        assert request.files['key'].filename == 'coinc.xml'
+        assert request.files['key'].read() == filecontent
+        return Response('OK')
+
+    with pytest_httpserver.HTTPServer() as httpserver:
+        httpserver.expect_oneshot_request('/').respond_with_handler(handler)
+        url = httpserver.url_for('/')
+        client = Session(url, upload_mode=upload_mode)
+        client.post(url, data={'comment': 'hi'},
+                    files={'key': (filename, None)})
+        httpserver.check_assertions()
+
+
+@pytest.mark.parametrize('upload_mode', STREAM_UPLOAD_MODES)
+def test_stream_file_changed(mock_request, tmpdir, upload_mode):
+    """Test that a streamed file is sent with the length that it had when the
+    request was prepared."""
+    filename = str(tmpdir / 'coinc.xml')
+    filecontent = b'<!--example data-->' * 100
+    with open(filename, 'wb') as f:
+        f.write(filecontent)
+    client = Session('https://example.org/', upload_mode=upload_mode,
+                     upload_chunk_size=64)
+    client.post('https://example.org/', files={'key': (filename, None)})
+    body = mock_request.call_args[1]['data']
+
+    # The file grows: the extra bytes are not sent.
+    with open(filename, 'ab') as f:
+        f.write(b'<!--more data-->' * 100)
+    streamed = b''.join(bytes(chunk) for chunk in body)
+    assert len(streamed) == body.len
+    assert filecontent in streamed
+
+    # The file shrinks: the body cannot be sent.
+    with open(filename, 'wb') as f:
+        f.write(filecontent[:100])
+    with pytest.raises(IOError):
+        for chunk in body:
+            pass
+
+
+@requires_mmap
+def test_mmap_empty_file(mock_request, tmpdir):
+    """Test that empty files can be uploaded in mmap mode."""
+    filename = str(tmpdir / 'empty.txt')
+    open(filename, 'wb').close()
+    client = Session('https://example.org/', upload_mode='mmap')
+    client.post('https://example.org/', files={'key': (filename, None)})
+    body = mock_request.call_args[1]['data']
+    assert len(b''.join(bytes(chunk) for chunk in body)) == body.len
+
+
+def test_executor(mock_request, tmpdir):
+    """Test preparing files in parallel with an executor."""
+    futures = pytest.importorskip('concurrent.futures')
+    files = []
+    for i in range(10):
+        filename = str(tmpdir / 'file{}.txt'.format(i))
+        with open(filename, 'wb') as f:
+            f.write(str(i).encode())
+        files.append(('key{}'.format(i), (filename, None)))
+
+    client = Session('https://example.org/')
+    client.post('https://example.org/', files=files)
+    expected = mock_request.call_args[1]['files']
+
+    with futures.ThreadPoolExecutor(4) as executor:
+        client = Session('https://example.org/', upload_executor=executor)
+        client.post('https://example.org/', files=files)
+    assert mock_request.call_args[1]['files'] == expected
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_compression(socket_enabled, tmpdir, compression):
+    """Test compressing uploaded files as they are sent."""
+    # FIXME: Python 2
+    pytest_httpserver = pytest.importorskip('pytest_httpserver')
+    from werkzeug.wrappers import Response
+    if compression == 'gzip':
+        decompress = gzip.decompress
+    else:
+        zstandard = pytest.importorskip('zstandard')
+
+        def decompress(data):
+            return zstandard.ZstdDecompressor().decompressobj().decompress(
+                data)
+
+    filename = str(tmpdir / 'coinc.xml')
+    filecontent = b'<!--example data-->' * 10000
+    with open(filename, 'wb') as f:
+        f.write(filecontent)
+    pngcontent = b'\x89PNG\r\n\x1a\n' + b'\x00' * 100
+
+    def handler(request):
+        assert request.headers['Transfer-Encoding'] == 'chunked'
+        xml = request.files['xml']
+        assert xml.filename == 'coinc.xml' + {'gzip': '.gz',
+                                              'zstd': '.zst'}[compression]
+        assert xml.mimetype == 'application/' + compression
+        data = xml.read()
+        assert len(data) < len(filecontent)
+        assert decompress(data) == filecontent
+        png = request.files['png']
+        assert png.filename == 'plot.png'
+        assert png.mimetype == 'image/png'
+        assert png.read() == pngcontent
+        return Response('OK')
+
+    with pytest_httpserver.HTTPServer() as httpserver:
+        httpserver.expect_oneshot_request('/').respond_with_handler(handler)
+        url = httpserver.url_for('/')
+        client = Session(url, upload_mode='stream',
+                         upload_compression=compression)
+        client.post(url, files={'xml': (filename, None),
+                                'png': ('plot.png', pngcontent)})
+        httpserver.check_assertions()
+
+
+def test_compression_in_memory(mock_request):
+    """Test compressing file contents that are already in memory."""
+    filecontent = b'<!--example data-->' * 10000
+    client = Session('https://example.org/', upload_compression='gzip')
+    client.post('https://example.org/',
+                files={'xml': ('coinc.xml', filecontent)})
+    body = mock_request.call_args[1]['data']
+    source, = [s for s in body._segments if not isinstance(s, bytes)]
+    data = b''.join(source.iter_chunks(1024))
+    assert zlib.decompress(data, 16 + zlib.MAX_WBITS) == filecontent
+
+
+def test_compression_invalid():
+    """Test that an unknown compression algorithm is an error."""
+    with pytest.raises(ValueError):
+        Session('https://example.org/', upload_compression='invalid')
+
+
+def test_compression_disabled(mock_request):
+    """Test disabling compression for an individual request."""
+    client = Session('https://example.org/', upload_compression='gzip')
+    client.post('https://example.org/', files={'key': ('foo.txt', b'bar')},
+                upload_compression=False)
+    assert mock_request.call_args[1]['files'] == [
+        ('key', ('foo.txt', b'bar', 'text/plain'))]
+
+
+class ResumableUploadServer(object):
+    """Stand-in for a server that implements resumable uploads."""
+
+    def __init__(self, fail=(), always_fail=()):
+        self.data = bytearray()
+        self.size = None
+        self.requests = []
+        self.fail = list(fail)
+        self.always_fail = set(always_fail)
+
+    def __call__(self, request):
+        from werkzeug.wrappers import Response
+
+        content_range = request.headers['Content-Range']
+        self.requests.append(content_range)
+        if content_range in self.fail:
+            self.fail.remove(content_range)
+            return Response('Service unavailable', 503)
+        if content_range in self.always_fail:
+            return Response('Service unavailable', 503)
+
+        first_last, size = content_range[len('bytes '):].split('/')
+        self.size = int(size)
+        if first_last != '*':
+            first, last = (int(i) for i in first_last.split('-'))
+            data = request.get_data()
+            assert len(data) == last - first + 1
+            assert first <= len(self.data)
+            self.data[first:] = data
+
+        if len(self.data) == self.size:
+            return Response('Created', 201)
+        headers = {'Range': 'bytes=0-{}'.format(len(self.data) - 1)
+                   } if self.data else {}
+        return Response('Resume Incomplete', 308, headers)
+
+
+@pytest.fixture
+def resumable_file(tmpdir):
+    """Generate a file to upload."""
+    filename = str(tmpdir / 'posterior_samples.hdf5')
+    with open(filename, 'wb') as f:
+        f.write(bytes(bytearray(range(256))) * 4)
+    return filename
+
+
+def test_upload_resumable(socket_enabled, resumable_file):
+    """Test that only failed chunks of resumable uploads are resent."""
+    # FIXME: Python 2
+    pytest_httpserver = pytest.importorskip('pytest_httpserver')
+
+    server = ResumableUploadServer(
+        fail=['bytes 300-399/1024', 'bytes */1024', 'bytes 300-399/1024'])
+    with pytest_httpserver.HTTPServer() as httpserver:
+        httpserver.expect_request('/').respond_with_handler(server)
+        url = httpserver.url_for('/')
+        client = Session(url)
+        response = client.upload_resumable(
+            url, resumable_file, chunk_size=100, backoff_factor=0)
+        httpserver.check_assertions()
+
+    assert response.status_code == 201
+    with open(resumable_file, 'rb') as f:
+        assert server.data == f.read()
+    assert server.requests[:9] == [
+        'bytes 0-99/1024', 'bytes 100-199/1024', 'bytes 200-299/1024',
+        'bytes 300-399/1024', 'bytes */1024', 'bytes */1024',
+        'bytes 300-399/1024', 'bytes */1024', 'bytes 300-399/1024']
+    assert server.requests[-1] == 'bytes 1000-1023/1024'
+
+
+def test_upload_resumable_max_retries(socket_enabled, monkeypatch,
+                                      resumable_file):
+    """Test giving up on a chunk that always fails."""
+    # FIXME: Python 2
+    pytest_httpserver = pytest.importorskip('pytest_httpserver')
+
+    sleeps = []
+    monkeypatch.setattr('requests_gracedb.file.sleep', sleeps.append)
+    server = ResumableUploadServer(always_fail=['bytes 100-199/1024'])
+    with pytest_httpserver.HTTPServer() as httpserver:
+        httpserver.expect_request('/').respond_with_handler(server)
+        url = httpserver.url_for('/')
+        client = Session(url)
+        with pytest.raises(requests.HTTPError):
+            client.upload_resumable(url, resumable_file, chunk_size=100,
+                                    max_retries=3, backoff_factor=1)
+
+    expected = ['bytes 100-199/1024', 'bytes */1024'] * 3
+    expected = ['bytes 0-99/1024'] + expected + ['bytes 100-199/1024']
+    assert server.requests == expected
+    assert sleeps == [1, 2, 4]
+
+
+def test_upload_resumable_empty_file(socket_enabled, tmpdir):
+    """Test uploading an empty file."""
+    # FIXME: Python 2
+    pytest_httpserver = pytest.importorskip('pytest_httpserver')
+
+    filename = str(tmpdir / 'empty.hdf5')
+    open(filename, 'wb').close()
+    server = ResumableUploadServer()
+    with pytest_httpserver.HTTPServer() as httpserver:
+        httpserver.expect_request('/').respond_with_handler(server)
+        url = httpserver.url_for('/')
+        client = Session(url)
+        response = client.upload_resumable(url, filename)
+
+    assert response.status_code == 201
+    assert server.requests == ['bytes */0']
+
+
+def test_upload_resumable_state_file(socket_enabled, resumable_file, tmpdir):
+    """Test resuming an interrupted upload from a state file."""
+    # FIXME: Python 2
+    pytest_httpserver = pytest.importorskip('pytest_httpserver')
+
+    state_file = str(tmpdir / 'state.json')
+    server = ResumableUploadServer(fail=['bytes 500-599/1024'])
+    with pytest_httpserver.HTTPServer() as httpserver:
+        httpserver.expect_request('/').respond_with_handler(server)
+        url = httpserver.url_for('/')
+
+        client = Session(url)
+        with pytest.raises(requests.HTTPError):
+            client.upload_resumable(url, resumable_file, chunk_size=100,
+                                    state_file=state_file, max_retries=0)
+        assert os.path.exists(state_file)
+        assert len(server.requests) == 6
+
+        client = Session(url)
+        response = client.upload_resumable(url, resumable_file,
+                                           chunk_size=100,
+                                           state_file=state_file)
+        httpserver.check_assertions()
+
+    assert response.status_code == 201
+    assert not os.path.exists(state_file)
+    assert server.requests[6] == 'bytes 500-599/1024'
+    with open(resumable_file, 'rb') as f:
+        assert server.data == f.read()
+
+
+@pytest.fixture
+def stdin_pipe(monkeypatch):
+    """Replace stdin with a pipe, and return the write end of the pipe."""
+    read_fd, write_fd = os.pipe()
+    reader = io.open(read_fd, 'rb')
+    writer = io.open(write_fd, 'wb', buffering=0)
+
+    class Stdin(object):
+        buffer = reader
+
+    monkeypatch.setattr('requests_gracedb.file.stdin', Stdin)
+    yield writer
+    reader.close()
+    if not writer.closed:
+        writer.close()
+
+
+def test_stdin_stream(mock_request, stdin_pipe):
+    """Test that data from stdin is passed through as it arrives."""
+    client = Session('https://example.org/', upload_mode='stream')
+    client.post('https://example.org/', files={'key': ('-', None)})
+    body = mock_request.call_args[1]['data']
+    assert body.len is None
+
+    chunks = iter(body)
+    next(chunks)  # field headers
+    stdin_pipe.write(b'first')
+    # Close the pipe later, so that the test would hang for a second if the
+    # body waited for EOF.
+    timer = threading.Timer(1, stdin_pipe.close)
+    timer.start()
+    try:
+        start = time.time()
+        assert next(chunks) == b'first'
+        assert time.time() - start < 0.5
+    finally:
+        timer.join()
+    assert next(chunks).endswith(b'--\r\n')
+
+
+def test_stdin_stream_upload(socket_enabled, stdin_pipe):
+    """Test streaming data from stdin to a server."""
+    # FIXME: Python 2
+    pytest_httpserver = pytest.importorskip('pytest_httpserver')
+    from werkzeug.wrappers import Response
+    filecontent = b'<!--example data-->' * 10000
+
+    def handler(request):
+        assert request.headers['Transfer-Encoding'] == 'chunked'
+        assert request.files['key'].read() == filecontent
+        return Response('OK')
+
+    def write():
+        for i in range(0, len(filecontent), 4096):
+            stdin_pipe.write(filecontent[i:i + 4096])
+        stdin_pipe.close()
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    with pytest_httpserver.HTTPServer() as httpserver:
+        httpserver.expect_oneshot_request('/').respond_with_handler(handler)
+        url = httpserver.url_for('/')
+        client = Session(url, upload_mode='stream')
+        client.post(url, files={'key': ('-', None)})
+        httpserver.check_assertions()
+    thread.join()
+
+
+@pytest.mark.parametrize('upload_compression', [None, 'gzip'])
+def test_progress(mock_request, tmpdir, upload_compression):
+    """Test reporting upload progress."""
+    filename = str(tmpdir / 'coinc.xml')
+    with open(filename, 'wb') as f:
+        f.write(b'x' * 1000)
+    progress = []
+
+    client = Session('https://example.org/', upload_chunk_size=300,
+                     upload_compression=upload_compression)
+    client.post('https://example.org/', files={'key': (filename, None)},
+                upload_progress=progress.append)
+    body = mock_request.call_args[1]['data']
+    for _ in body:
+        pass
+
+    assert [p.bytes_sent for p in progress] == [300, 600, 900, 1000]
+    for p in progress:
+        assert isinstance(p, UploadProgress)
+        assert p.field == 'key'
+        assert p.filename == 'coinc.xml'
+        assert p.total_bytes == 1000
+        assert p.elapsed >= 0
+        assert p.throughput is None or p.throughput > 0
+
+
+def test_progress_throughput(mock_request, monkeypatch):
+    """Test that the throughput is finite if the clock does not advance
+    between chunks."""
+    clock = iter([0.0, 0.0, 1.0, 1.0, 2.0])
+    monkeypatch.setattr('requests_gracedb.file.monotonic',
+                        lambda: next(clock))
+    progress = []
+
+    client = Session('https://example.org/', upload_mode='stream',
+                     upload_chunk_size=300)
+    client.post('https://example.org/', files={'key': ('a.txt', b'x' * 1000)},
+                upload_progress=progress.append)
+    body = mock_request.call_args[1]['data']
+    for _ in body:
+        pass
+
+    assert [p.throughput for p in progress] == [None, 600.0, 600.0, 400.0]
+
+
+@pytest.mark.skipif(six.PY2, reason='requests encodes buffered bodies')
+def test_buffered_body(monkeypatch, tmpdir):
+    """Test that buffered request bodies are sent without concatenating."""
+    filename = str(tmpdir / 'coinc.xml')
+    with open(filename, 'wb') as f:
+        f.write(b'<!--example data-->')
+    filecontent = b'x' * 100000
+    data = {'comment': 'hi'}
+
+    client = Session('https://example.org/')
+    with open(filename, 'rb') as fileobj:
+        prepared = client.prepare_request(requests.Request(
+            'POST', 'https://example.org/', data=data,
+            files={'key1': ('foo.txt', filecontent), 'key2': fileobj}))
+    body = prepared.body
+    chunks = list(body)
+    assert chunks[1].obj is filecontent
+
+    content_type = prepared.headers['Content-Type']
+    boundary = content_type.split('boundary=')[1]
+    monkeypatch.setattr('urllib3.filepost.choose_boundary', lambda: boundary)
+    expected = requests.Request(
+        'POST', 'https://example.org/', data=data,
+        files={'key1': ('foo.txt', filecontent, 'text/plain'),
+               'key2': ('coinc.xml', b'<!--example data-->',
+                        'application/xml')}).prepare()
+    streamed = b''.join(bytes(chunk) for chunk in chunks)
+    assert streamed == expected.body
+    assert int(prepared.headers['Content-Length']) == len(streamed)
+
+
+def test_buffered_upload_redirect(socket_enabled):
+    """Test that buffered request bodies are sent again after redirects."""
+    # FIXME: Python 2
+    pytest_httpserver = pytest.importorskip('pytest_httpserver')
+    from werkzeug.wrappers import Response
+    filecontent = b'<!--example data-->' * 10000
+
+    def handler(request):
+        assert request.files['key'].read() == filecontent
+        return Response('OK')
+
+    with pytest_httpserver.HTTPServer() as httpserver:
+        httpserver.expect_oneshot_request('/').respond_with_data(
+            status=307, headers={'Location': httpserver.url_for('/new')})
+        httpserver.expect_oneshot_request('/new').respond_with_handler(
+            handler)
+        url = httpserver.url_for('/')
+        client = Session(url)
+        client.post(url, files={'key': ('coinc.xml', filecontent)})
+        httpserver.check_assertions()
@@ -0,0 +1,261 @@
+#
+# Copyright (C) 2019-2020  Leo P. Singer <leo.singer@ligo.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests for :mod:`requests_gracedb.http2`."""
+from __future__ import absolute_import
+from datetime import datetime
+import json
+from multiprocessing.pool import ThreadPool
+import socket
+import ssl
+from threading import Lock, Thread
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric.rsa import generate_private_key
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, NoEncryption, PrivateFormat)
+from cryptography.x509 import (
+    CertificateBuilder, DNSName, Name, NameAttribute, random_serial_number,
+    load_der_x509_certificate, SubjectAlternativeName)
+from cryptography.x509.oid import NameOID
+import pytest
+import six
+
+from .. import Session
+
+h2 = pytest.importorskip('h2')
+pytest.importorskip('httpx')
+from h2.config import H2Configuration  # noqa: E402
+from h2.connection import H2Connection  # noqa: E402
+from h2.events import (  # noqa: E402
+    ConnectionTerminated, DataReceived, RequestReceived, StreamEnded)
+
+
+def make_cert(tmpdir, name):
+    """Generate a self-signed certificate and key for localhost, and return
+    the names of the certificate and key files."""
+    backend = default_backend()
+    key = generate_private_key(65537, 2048, backend)
+    subject = Name([NameAttribute(NameOID.COMMON_NAME, six.text_type(name))])
+    cert = CertificateBuilder().subject_name(
+        subject
+    ).issuer_name(
+        subject
+    ).serial_number(
+        random_serial_number()
+    ).public_key(
+        key.public_key()
+    ).not_valid_before(
+        datetime(2008, 1, 1)
+    ).not_valid_after(
+        datetime(3020, 1, 1)
+    ).add_extension(
+        SubjectAlternativeName([DNSName(u'localhost')]),
+        critical=False
+    ).sign(
+        key, SHA256(), backend
+    )
+    cert_file = str(tmpdir / (name + '_cert.pem'))
+    key_file = str(tmpdir / (name + '_key.pem'))
+    with open(cert_file, 'wb') as f:
+        f.write(cert.public_bytes(Encoding.PEM))
+    with open(key_file, 'wb') as f:
+        f.write(key.private_bytes(
+            Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()))
+    return cert_file, key_file
+
+
+class H2Server(object):
+    """A minimal HTTP/2 server that runs in background threads.
+
+    It responds to every request with a JSON object that contains the number
+    of the connection, the serial number of the client certificate (if any),
+    and the length of the request body.
+    """
+
+    def __init__(self, context):
+        context.set_alpn_protocols(['h2'])
+        self.context = context
+        self.connections = 0
+        self._lock = Lock()
+        self._socks = []
+        self._listener = socket.socket()
+        self._listener.bind(('localhost', 0))
+        self._listener.listen(16)
+        self.port = self._listener.getsockname()[1]
+        self._start(self._serve)
+
+    def url_for(self, path):
+        return 'https://localhost:{}{}'.format(self.port, path)
+
+    def _start(self, target, *args):
+        thread = Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                return
+            self._start(self._handle, sock)
+
+    def _handle(self, sock):
+        try:
+            sock = self.context.wrap_socket(sock, server_side=True)
+        except (OSError, ssl.SSLError):
+            sock.close()
+            return
+        with self._lock:
+            self.connections += 1
+            number = self.connections
+            self._socks.append(sock)
+        der = sock.getpeercert(True)
+        serial = None if der is None else str(
+            load_der_x509_certificate(der, default_backend()).serial_number)
+        conn = H2Connection(H2Configuration(client_side=False))
+        conn.initiate_connection()
+        bodies = {}
+        try:
+            sock.sendall(conn.data_to_send())
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                for event in conn.receive_data(data):
+                    if isinstance(event, RequestReceived):
+                        bodies[event.stream_id] = 0
+                    elif isinstance(event, DataReceived):
+                        bodies[event.stream_id] += len(event.data)
+                        conn.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, StreamEnded):
+                        body = json.dumps({
+                            'connection': number, 'serial': serial,
+                            'length': bodies.pop(event.stream_id)
+                        }).encode()
+                        conn.send_headers(event.stream_id, [
+                            (':status', '200'),
+                            ('content-type', 'application/json'),
+                            ('content-length', str(len(body)))])
+                        conn.send_data(event.stream_id, body, end_stream=True)
+                    elif isinstance(event, ConnectionTerminated):
+                        return
+                sock.sendall(conn.data_to_send())
+        except (OSError, ssl.SSLError):
+            pass
+        finally:
+            sock.close()
+
+    def close(self):
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listener.close()
+        with self._lock:
+            socks = list(self._socks)
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+@pytest.fixture
+def server_cert(tmpdir):
+    """Generate server certificate and key files."""
+    return make_cert(tmpdir, 'server')
+
+
+@pytest.fixture
+def client_cert(tmpdir):
+    """Generate client certificate and key files."""
+    return make_cert(tmpdir, 'client')
+
+
+@pytest.fixture
+def server(socket_enabled, server_cert, client_cert):
+    """Run test HTTP/2 server that requires a client certificate."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*server_cert)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(client_cert[0])
+    server = H2Server(context)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def client(server, server_cert, client_cert):
+    """Create test client."""
+    url = server.url_for('/')
+    with Session(url, cert=client_cert, http2=True) as client:
+        client.verify = server_cert[0]
+        yield client
+
+
+def test_http2_multiplexing(client, server):
+    """Test that concurrent requests share one HTTP/2 connection."""
+    url = server.url_for('/')
+    response = client.get(url)
+    assert response.raw.version == 20
+    assert response.json()['connection'] == 1
+
+    pool = ThreadPool(8)
+    try:
+        results = pool.map(lambda _: client.get(url).json(), range(32))
+    finally:
+        pool.close()
+    assert all(result['connection'] == 1 for result in results)
+    assert server.connections == 1
+
+
+def test_http2_request_body(client, server):
+    """Test sending request bodies over HTTP/2."""
+    url = server.url_for('/')
+    assert client.post(url, data=b'x' * 100000).json()['length'] == 100000
+    assert client.post(url, data=iter([b'foo', b'bar'])).json()['length'] == 6
+
+
+def test_http2_cert_reload(client, server, client_cert, tmpdir):
+    """Test that a new connection is opened when the client certificate
+    changes."""
+    url = server.url_for('/')
+    result = client.get(url).json()
+    assert result['connection'] == 1
+
+    # Replace the client certificate with a new one that the server trusts.
+    new_cert = make_cert(tmpdir, 'new_client')
+    for old_file, new_file in zip(client_cert, new_cert):
+        with open(new_file, 'rb') as f:
+            data = f.read()
+        with open(old_file, 'wb') as f:
+            f.write(data)
+    server.context.load_verify_locations(client_cert[0])
+
+    new_result = client.get(url).json()
+    assert new_result['connection'] == 2
+    assert new_result['serial'] != result['serial']
+    assert client.get(url).json()['connection'] == 2
+
+
+def test_http2_incompatible_options():
+    """Test that http2 cannot be combined with watching certificates."""
+    with pytest.raises(ValueError):
+        Session(http2=True, cert_reload=True, cert_reload_watch=True)
@@ -0,0 +1,81 @@
+#
+# Copyright (C) 2019-2020  Leo P. Singer <leo.singer@ligo.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+"""Tests for :mod:`requests_gracedb.prewarm`."""
+import pytest
+
+from .. import Session
+
+# FIXME: Python 2
+pytest_httpserver = pytest.importorskip('pytest_httpserver')
+
+
+@pytest.fixture
+def server(socket_enabled):
+    """Run test http server that can handle several connections at once."""
+    with pytest_httpserver.HTTPServer(threaded=True) as server:
+        server.expect_request('/').respond_with_json({'foo': 'bar'})
+        yield server
+
+
+def join_prewarm_threads(client):
+    """Wait until the connections have been pre-warmed."""
+    while True:
+        alive = [thread for thread in client._prewarm_threads
+                 if thread.is_alive()]
+        if not alive:
+            break
+        for thread in alive:
+            thread.join(5)
+
+
+def test_prewarm(server):
+    """Test opening connections when the session is created."""
+    url = server.url_for('/')
+    with Session(url, force_noauth=True, prewarm=3) as client:
+        join_prewarm_threads(client)
+        pool = client.get_adapter(url).get_connection(url)
+        conns = [conn for conn in pool.pool.queue if conn is not None]
+        assert len(conns) == 3
+        assert all(conn.sock is not None for conn in conns)
+        assert pool.num_connections == 3
+
+        # Requests use the open connections.
+        assert client.get(url).json() == {'foo': 'bar'}
+        assert pool.num_connections == 3
+
+
+def test_prewarm_limited_to_pool_size(server):
+    """Test that no more connections are opened than the pool can hold."""
+    url = server.url_for('/')
+    with Session(url, force_noauth=True, prewarm=100) as client:
+        join_prewarm_threads(client)
+        pool = client.get_adapter(url).get_connection(url)
+        assert pool.num_connections == pool.pool.maxsize
+
+
+def test_prewarm_unreachable(caplog):
+    """Test that errors while pre-warming connections are only logged."""
+    url = 'http://localhost:1/'
+    with Session(url, force_noauth=True, prewarm=1) as client:
+        join_prewarm_threads(client)
+    assert 'Failed to pre-warm connection' in caplog.text
+
+
+def test_prewarm_invalid():
+    """Test that the number of connections must not be negative."""
+    with pytest.raises(ValueError):
+        Session(prewarm=-1)